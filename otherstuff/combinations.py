@@ -51,11 +51,26 @@ In any case: I give you the proper solution. An O(2^N) algorithm that
 produces the correct output.
 '''
 
-def combinations(iterable):
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+def combinations(iterable, max_size=None, prune=None):
 	'''
 	For an iterable set, return all the combinations of things in the
 	set as a list. Inclues the empty set and the set itself.
 
+	If max_size is given only subsets with at most max_size things in
+	them are returned. If prune is given it's called with each candidate
+	subset and should return True to throw that subset away. The prune
+	predicate has to be monotone: if it prunes a subset it must prune
+	every superset of it too, because pruned subsets are never extended.
+	With either option the work done is proportional to the number of
+	subsets returned rather than to 2^N.
+
 	>>> combinations('')
 	['']
 	>>> len(combinations(''))
@@ -80,13 +95,48 @@ def combinations(iterable):
 	32
 	>>> len(combinations('abcdef'))
 	64
+	>>> combinations('abcd', max_size=2)
+	['', 'a', 'b', 'ab', 'c', 'ac', 'bc', 'd', 'ad', 'bd', 'cd']
+	>>> combinations('abc', max_size=0)
+	['']
+	>>> cost = {'a': 1, 'b': 2, 'c': 3, 'd': 4}
+	>>> combinations('abcd', prune=lambda s: sum(cost[c] for c in s) > 4)
+	['', 'a', 'b', 'ab', 'c', 'ac', 'd']
+	>>> combinations('ab', prune=lambda s: len(s) == 0)
+	[]
+	>>> combinations('ab', prune=lambda s: True)
+	[]
+	>>> len(combinations('abcdefghijklmnopqrstuvwxyz' * 4, max_size=1))
+	105
 	'''
-	# Start with the empty case:
+	# Start with the empty case, unless that's pruned and so is
+	# everything else:
+	if prune is not None and prune(''):
+		return list()
 	collector = ['']
-	# For each thing in iterable, permute thing with collector and
-	# then add the result to the existing collector value.
+	if max_size is None and prune is None:
+		# For each thing in iterable, permute thing with collector and
+		# then add the result to the existing collector value.
+		for character in iterable:
+			collector = collector + _combinations_helper(collector, character)
+		return collector
+	# Only extend the subsets that can still grow. Anything that's full
+	# or was pruned drops out here and none of its supersets are ever
+	# built, which is what keeps this from being O(2^N).
+	growing = list(collector)
+	if max_size is not None and max_size < 1:
+		growing = list()
 	for character in iterable:
-		collector = collector + _combinations_helper(collector, character)
+		if not growing:
+			break
+		added = list()
+		for item in _combinations_helper(growing, character):
+			if prune is None or not prune(item):
+				added.append(item)
+		collector.extend(added)
+		if max_size is not None:
+			added = [item for item in added if len(item) < max_size]
+		growing.extend(added)
 	return collector
 
 def _combinations_helper(iterable, character):
@@ -111,6 +161,196 @@ def _combinations_helper(iterable, character):
 			return_array.append(item + character)
 	return return_array
 
+# Events reported by gray_deltas() as consecutive subsets are walked.
+ADDED = 'added'
+REMOVED = 'removed'
+
+def gray_deltas(iterable):
+	'''
+	Walks all the subsets of iterable in Gray-code order, where each
+	subset differs from the one before it by exactly one thing. Rather
+	than yielding the subsets themselves it yields the change needed to
+	get from one subset to the next as an (ADDED, thing) or (REMOVED,
+	thing) tuple. The walk starts at the empty set, so there are 2^N - 1
+	deltas for a set of N things.
+
+	This is handy when the work you do per subset is an aggregate like
+	a sum or a hash: you can update it in O(1) per step instead of
+	recomputing it from scratch in O(N) for every subset.
+
+	>>> list(gray_deltas(''))
+	[]
+	>>> list(gray_deltas('a'))
+	[('added', 'a')]
+	>>> list(gray_deltas('ab'))
+	[('added', 'a'), ('added', 'b'), ('removed', 'a')]
+	>>> len(list(gray_deltas('abcde')))
+	31
+	'''
+	items = list(iterable)
+	member = [False] * len(items)
+	# Count by hand rather than with range() so Python 2 doesn't build a
+	# list of all 2^N steps up front.
+	step = 1
+	steps = 1 << len(items)
+	while step < steps:
+		# The bit that flips between Gray codes step-1 and step is the
+		# lowest set bit of step.
+		index = (step & -step).bit_length() - 1
+		member[index] = not member[index]
+		if member[index]:
+			yield (ADDED, items[index])
+		else:
+			yield (REMOVED, items[index])
+		step = step + 1
+
+def gray_walk(iterable, added, removed):
+	'''
+	Walks all the subsets of iterable in Gray-code order calling
+	added(thing) or removed(thing) as each step changes the current
+	subset. Returns the number of subsets visited, including the empty
+	set the walk starts from.
+
+	Keeping a running subset sum is O(1) per subset this way:
+
+	>>> sums = [0]
+	>>> total = [0]
+	>>> def added(x):
+	...     total[0] += x
+	...     sums.append(total[0])
+	>>> def removed(x):
+	...     total[0] -= x
+	...     sums.append(total[0])
+	>>> gray_walk([1, 2, 4], added, removed)
+	8
+	>>> sums
+	[0, 1, 3, 2, 6, 7, 5, 4]
+	>>> sorted(sums)
+	[0, 1, 2, 3, 4, 5, 6, 7]
+	'''
+	visited = 1
+	for event, thing in gray_deltas(iterable):
+		if event == ADDED:
+			added(thing)
+		else:
+			removed(thing)
+		visited = visited + 1
+	return visited
+
+def gray_combinations(iterable):
+	'''
+	Same output as combinations() but in Gray-code order, so each subset
+	differs from the one before it by exactly one character. Building
+	every subset string is still O(N) per subset -- use gray_deltas() or
+	gray_walk() if you only need to track changes.
+
+	>>> gray_combinations('')
+	['']
+	>>> gray_combinations('ab')
+	['', 'a', 'ab', 'b']
+	>>> gray_combinations('abc')
+	['', 'a', 'ab', 'b', 'bc', 'abc', 'ac', 'c']
+	>>> sorted(gray_combinations('abcd')) == sorted(combinations('abcd'))
+	True
+	'''
+	items = list(iterable)
+	current = set()
+	collector = ['']
+	for event, thing in gray_deltas(range(len(items))):
+		if event == ADDED:
+			current.add(thing)
+		else:
+			current.remove(thing)
+		collector.append(''.join(items[i] for i in sorted(current)))
+	return collector
+
+def bitmask_batches(size, batch_size=1 << 20):
+	'''
+	Generates every subset of a set of size things as integer bitmasks,
+	where bit i set means thing i is in the subset. The masks come in
+	blocks of at most batch_size as numpy uint64 arrays so they can be
+	scored with vectorized operations instead of one string at a time.
+	The masks are in the same order combinations() produces subsets.
+
+	>>> [[int(m) for m in b] for b in bitmask_batches(2)]
+	[[0, 1, 2, 3]]
+	>>> [[int(m) for m in b] for b in bitmask_batches(3, batch_size=3)]
+	[[0, 1, 2], [3, 4, 5], [6, 7]]
+	>>> next(bitmask_batches(64))
+	Traceback (most recent call last):
+	...
+	ValueError: bitmask subsets only support up to 63 things, got 64
+	'''
+	if numpy is None:
+		raise ImportError('bitmask_batches() needs numpy')
+	if size > 63:
+		raise ValueError('bitmask subsets only support up to 63 things, got %d' % size)
+	total = 1 << size
+	for start in range(0, total, batch_size):
+		stop = min(start + batch_size, total)
+		yield numpy.arange(start, stop, dtype=numpy.uint64)
+
+def membership_matrix(masks, size):
+	'''
+	Expands an array of bitmasks in to a boolean matrix with one row per
+	mask and one column per thing, True where the thing is in the
+	subset.
+
+	>>> membership_matrix(numpy.arange(4, dtype=numpy.uint64), 2).astype(int).tolist()
+	[[0, 0], [1, 0], [0, 1], [1, 1]]
+	'''
+	shifts = numpy.arange(size, dtype=numpy.uint64)
+	return ((masks[:, None] >> shifts) & numpy.uint64(1)).astype(bool)
+
+def gather_subsets(masks, things, fill=0):
+	'''
+	Turns an array of bitmasks in to a matrix with one row per mask
+	holding the things in that subset, and fill everywhere the thing is
+	not in the subset. Summing the rows gives every subset sum in one
+	vectorized call.
+
+	>>> values = numpy.array([1, 2, 4])
+	>>> gathered = gather_subsets(numpy.arange(8, dtype=numpy.uint64), values)
+	>>> gathered.tolist()[:4]
+	[[0, 0, 0], [1, 0, 0], [0, 2, 0], [1, 2, 0]]
+	>>> gathered.sum(axis=1).tolist()
+	[0, 1, 2, 3, 4, 5, 6, 7]
+	'''
+	things = numpy.asarray(things)
+	member = membership_matrix(masks, len(things))
+	return numpy.where(member, things[None, :], fill)
+
+def benchmark(size=20):
+	'''
+	Times computing every subset sum of size small integers using the
+	list-of-strings combinations() path against the bitmask_batches()
+	path. Returns a dict of seconds taken by each.
+
+	On my machine with size=20 (about a million subsets) the string path
+	takes over a second and the batched path about a fifth of
+	a second.
+
+	>>> sorted(benchmark(8).keys())
+	['bitmask', 'strings']
+	'''
+	things = [chr(ord('a') + i) for i in range(size)]
+	cost = dict((c, i + 1) for i, c in enumerate(things))
+	results = dict()
+
+	start = time.time()
+	string_sums = [sum(cost[c] for c in subset) for subset in combinations(things)]
+	results['strings'] = time.time() - start
+
+	start = time.time()
+	values = numpy.arange(1, size + 1)
+	bitmask_sums = list()
+	for masks in bitmask_batches(size):
+		bitmask_sums.append(membership_matrix(masks, size).dot(values))
+	results['bitmask'] = time.time() - start
+
+	assert numpy.concatenate(bitmask_sums).tolist() == string_sums
+	return results
+
 if __name__ == '__main__':
 	import doctest
 	doctest.testmod()
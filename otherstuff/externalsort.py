@@ -0,0 +1,207 @@
+#!/bin/env python3
+
+'''
+externalsort
+
+Sorts files too big to sort in memory with the mergesort module. It's
+Python 3 only since it needs array's 'q' typecode for int64 records.
+
+The file is read in chunks that take about memory bytes to sort. Each
+chunk is sorted in memory and written out to a temporary run file, and then the runs
+are merged fan_in at a time, reading and writing them in block sized
+pieces, until there's only one left. If there are more than fan_in
+runs that takes more than one pass.
+
+Records are either native int64s, records='int64', or lines of bytes
+ending in a newline, records='lines', which sort bytewise.
+
+Sorting a chunk takes a lot more memory than the chunk does on disk,
+since every record becomes a Python object in a list and the sort
+merges in to more lists. The chunk sizes allow for that with
+INT64_OVERHEAD and LINE_OVERHEAD, which I measured with adaptive_mergesort(): an 8 byte
+int64 takes about 64 bytes to sort, and a line about 64 bytes more
+than its own length.
+
+>>> import os, random, tempfile
+>>> directory = tempfile.mkdtemp()
+>>> source = os.path.join(directory, 'numbers')
+>>> destination = os.path.join(directory, 'sorted')
+>>> numbers = array.array('q', [random.randrange(-10**12, 10**12) for i in range(10000)])
+>>> with open(source, 'wb') as f:
+...     numbers.tofile(f)
+>>> stats = external_sort(source, destination, memory=64000, fan_in=4, block=1024)
+>>> stats['runs'], stats['passes']
+(10, 2)
+>>> with open(destination, 'rb') as f:
+...     result = array.array('q', f.read())
+>>> result.tolist() == sorted(numbers)
+True
+>>> sorted(stats.keys())
+['bytes', 'mb_per_sec', 'passes', 'peak_rss_mb', 'runs', 'seconds']
+
+>>> with open(source, 'wb') as f:
+...     f.write(b'pear\\napple\\nfig\\napple\\nbanana')
+27
+>>> stats = external_sort(source, destination, records='lines', memory=10)
+>>> open(destination, 'rb').read().split()
+[b'apple', b'apple', b'banana', b'fig', b'pear']
+'''
+
+import array
+import heapq
+import os
+import shutil
+import tempfile
+import time
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+from mergesort import adaptive_mergesort
+
+# Bytes of memory it takes to sort a record on top of the record's own.
+INT64_OVERHEAD = 56
+LINE_OVERHEAD = 64
+
+def external_sort(source, destination, records='int64', memory=64 << 20, fan_in=64,
+		block=1 << 16, sort=adaptive_mergesort, temp_dir=None):
+	'''
+	Sorts the records in the file source in to the file destination,
+	using about memory bytes to sort each chunk of records while the
+	runs are made and fan_in * block bytes while they're merged. sort
+	is what sorts each chunk and returns the sorted list; memory is
+	only right for sorts that take about as much as
+	adaptive_mergesort().
+
+	Returns a dict of how many bytes were sorted, how long it took and
+	the MB/s that works out to, how many runs were made and how many
+	merge passes it took, and the peak resident memory of the process
+	in MB, or None where the resource module isn't around.
+	'''
+	if records not in ('int64', 'lines'):
+		raise ValueError('records has to be int64 or lines, not %r' % (records,))
+	if fan_in < 2:
+		raise ValueError('fan_in has to be at least 2, not %r' % (fan_in,))
+	start = time.time()
+	directory = tempfile.mkdtemp(dir=temp_dir)
+	try:
+		runs = _make_runs(source, directory, records, memory, sort)
+		run_count = len(runs)
+		passes = 0
+		while len(runs) > fan_in:
+			passes = passes + 1
+			merged = list()
+			for first in range(0, len(runs), fan_in):
+				path = os.path.join(directory, 'pass%d-%d' % (passes, first))
+				_merge_runs(runs[first:first + fan_in], path, records, block)
+				merged.append(path)
+			runs = merged
+		passes = passes + 1
+		_merge_runs(runs, destination, records, block)
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+	elapsed = time.time() - start
+	size = os.path.getsize(destination)
+	peak = None
+	if resource is not None:
+		# ru_maxrss is in KB on Linux.
+		peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+	return {
+		'bytes': size,
+		'seconds': elapsed,
+		'mb_per_sec': size / float(1 << 20) / max(elapsed, 1e-9),
+		'runs': run_count,
+		'passes': passes,
+		'peak_rss_mb': peak,
+	}
+
+def _make_runs(source, directory, records, memory, sort):
+	'''
+	Cuts source up in to sorted run files in directory and returns
+	their paths.
+	'''
+	runs = list()
+	with open(source, 'rb') as f:
+		while True:
+			if records == 'int64':
+				chunk = array.array('q')
+				data = f.read(max(memory // (chunk.itemsize + INT64_OVERHEAD), 1) * chunk.itemsize)
+				if not data:
+					break
+				chunk.frombytes(data)
+				del(data)
+				chunk = chunk.tolist()
+				chunk = array.array('q', sort(chunk))
+			else:
+				chunk = _read_lines(f, memory)
+				if not chunk:
+					break
+				if not chunk[-1].endswith(b'\n'):
+					chunk[-1] = chunk[-1] + b'\n'
+				chunk = sort(chunk)
+			path = os.path.join(directory, 'run%d' % len(runs))
+			with open(path, 'wb') as run:
+				if records == 'int64':
+					chunk.tofile(run)
+				else:
+					run.writelines(chunk)
+			runs.append(path)
+	return runs
+
+def _read_lines(f, memory):
+	'''
+	Reads lines from f until sorting them would take about memory bytes,
+	or at least one line.
+	'''
+	lines = list()
+	for line in f:
+		lines.append(line)
+		memory = memory - len(line) - LINE_OVERHEAD
+		if memory <= 0:
+			break
+	return lines
+
+def _read_run(path, records, block):
+	'''
+	Yields the records in a run file, reading it block bytes at a time.
+	'''
+	with open(path, 'rb', block) as run:
+		if records == 'lines':
+			for line in run:
+				yield line
+			return
+		size = max(block // 8, 1) * 8
+		while True:
+			data = run.read(size)
+			if not data:
+				return
+			numbers = array.array('q')
+			numbers.frombytes(data)
+			for number in numbers:
+				yield number
+
+def _merge_runs(runs, destination, records, block):
+	'''
+	Merges the sorted run files in to destination and deletes them.
+	'''
+	merged = heapq.merge(*[_read_run(path, records, block) for path in runs])
+	with open(destination, 'wb', block) as out:
+		if records == 'lines':
+			out.writelines(merged)
+		else:
+			buffered = array.array('q')
+			size = max(block // 8, 1)
+			for number in merged:
+				buffered.append(number)
+				if len(buffered) == size:
+					buffered.tofile(out)
+					buffered = array.array('q')
+			buffered.tofile(out)
+	for path in runs:
+		os.remove(path)
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
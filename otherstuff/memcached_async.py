@@ -0,0 +1,114 @@
+#!/bin/env python3
+
+'''
+memcached_async
+
+Stale-while-revalidate loading in front of a memcached.Cache for asyncio
+code. It's Python 3 only, unlike the Cache itself.
+
+Cache.get_or_load() blocks the thread that's waiting on a load, which
+blocks the whole event loop in an async service. And when a hot key
+expires every request for it waits on the backend until it's loaded
+again. AsyncCache.aget_or_load() keeps each value around for stale_ttl
+seconds past its ttl. A request for it in that window gets the stale
+value straight away, and one background task loads a fresh one. Only
+a real miss waits on the backend, and everyone who misses on a key at
+the same time shares the one load.
+
+>>> calls = list()
+>>> async def fetch(key):
+...     calls.append(key)
+...     await asyncio.sleep(0.05)
+...     return '%s v%d' % (key, len(calls))
+>>> async def demo():
+...     cache = AsyncCache(Cache(max_size=10))
+...     first = await asyncio.gather(*[cache.aget_or_load('k', fetch, ttl=0.5, stale_ttl=10) for i in range(10)])
+...     await asyncio.sleep(0.6)
+...     start = time.time()
+...     stale = await cache.aget_or_load('k', fetch, ttl=0.5, stale_ttl=10)
+...     waited = time.time() - start
+...     await asyncio.sleep(0.1)
+...     fresh = await cache.aget_or_load('k', fetch, ttl=0.5, stale_ttl=10)
+...     return set(first), stale, waited < 0.01, fresh
+>>> asyncio.run(demo())
+({'k v1'}, 'k v1', True, 'k v2')
+>>> calls
+['k', 'k']
+'''
+
+import asyncio
+import functools
+import time
+
+from memcached import Cache
+
+class AsyncCache():
+	'''
+	Wraps a Cache, or a ShardedCache, for aget_or_load(). The cache holds
+	(value, fresh_until) tuples for it. No more than max_loads calls to
+	the loaders run at once, whether they're for misses or for
+	refreshing stale values.
+
+	A load that fails is an error for everyone waiting on it. A refresh
+	that fails leaves the stale value to be served until the next
+	request after it tries again, or until stale_ttl runs out.
+
+	>>> async def broken(key):
+	...     raise KeyError(key)
+	>>> async def demo():
+	...     cache = AsyncCache(Cache(max_size=10), max_loads=2)
+	...     results = await asyncio.gather(*[cache.aget_or_load(i, broken, ttl=1) for i in (1, 1, 2)], return_exceptions=True)
+	...     return results, cache.inflight
+	>>> asyncio.run(demo())
+	([KeyError(1), KeyError(1), KeyError(2)], {})
+	'''
+
+	def __init__(self, cache, max_loads=8):
+		self.cache = cache
+		self.max_loads = max_loads
+		self.loads = None # Made on first use so it's on the running loop
+		self.inflight = dict() # Key to the task loading it
+
+	async def aget_or_load(self, key, coro_fn, ttl, stale_ttl=0):
+		'''
+		Get the value for key, awaiting coro_fn(key) to load it if it
+		isn't cached. A value is fresh for ttl seconds and then served
+		stale for up to stale_ttl more while it's refreshed.
+		'''
+		entry = self.cache.get(key)
+		if entry is not None:
+			value, fresh_until = entry
+			if fresh_until <= time.time() and key not in self.inflight:
+				self._start(key, coro_fn, ttl, stale_ttl)
+			return value
+		task = self.inflight.get(key)
+		if task is None:
+			task = self._start(key, coro_fn, ttl, stale_ttl)
+		# One caller being cancelled mustn't cancel the load for the rest.
+		return await asyncio.shield(task)
+
+	def _start(self, key, coro_fn, ttl, stale_ttl):
+		task = asyncio.ensure_future(self._load(key, coro_fn, ttl, stale_ttl))
+		self.inflight[key] = task
+		task.add_done_callback(functools.partial(self._finished, key))
+		return task
+
+	def _finished(self, key, task):
+		if self.inflight.get(key) is task:
+			del(self.inflight[key])
+		if not task.cancelled():
+			# Nobody awaits a refresh, so fetch its exception here to
+			# stop asyncio complaining that it was never retrieved.
+			task.exception()
+
+	async def _load(self, key, coro_fn, ttl, stale_ttl):
+		if self.loads is None:
+			self.loads = asyncio.Semaphore(self.max_loads)
+		async with self.loads:
+			value = await coro_fn(key)
+		self.cache.put(key, (value, time.time() + ttl), ttl + stale_ttl)
+		return value
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -0,0 +1,359 @@
+#!/bin/env python3
+
+'''
+memcached_server
+
+An asyncio server that speaks the memcached text protocol in front of a
+memcached.Cache so the cache can be shared by anything that has a stock
+memcached client. It's Python 3 only, unlike the Cache itself.
+
+The supported commands are:
+
+    get <key>*
+    gets <key>*
+    set <key> <flags> <exptime> <bytes> [noreply]
+    delete <key> [noreply]
+    stats
+
+Commands can be pipelined: every complete command in a chunk read off
+the socket is handled in one go and the replies are written back with
+a single write, so a client that sends a batch of gets gets one batch
+of replies back instead of a write per key.
+
+>>> async def demo():
+...     server = await start_server(Cache(max_size=10), port=0)
+...     port = server.sockets[0].getsockname()[1]
+...     reader, writer = await asyncio.open_connection('127.0.0.1', port)
+...     writer.write(b'set a 5 0 3\\r\\none\\r\\nset b 0 0 3\\r\\ntwo\\r\\nget a b c\\r\\n')
+...     replies = await reader.readuntil(b'END\\r\\n')
+...     writer.close()
+...     server.close()
+...     await server.wait_closed()
+...     return replies
+>>> for line in asyncio.run(demo()).split(b'\\r\\n'):
+...     print(line.decode())
+STORED
+STORED
+VALUE a 5 3
+one
+VALUE b 0 3
+two
+END
+<BLANKLINE>
+'''
+
+import asyncio
+import itertools
+import os
+import threading
+import time
+
+from memcached import Cache, getsizeof_weigher
+
+# Memcached treats expiry times bigger than this as absolute unix times
+# rather than seconds from now.
+RELATIVE_EXPTIME_LIMIT = 60 * 60 * 24 * 30
+
+def stored_weigher(key, value):
+	'''
+	Weighs what the server stores in the cache by the length of the key
+	and the data block.
+
+	>>> stored_weigher(b'key', (0, b'hello', 1))
+	8
+	'''
+	return len(key) + len(value[1])
+
+class MemcachedProtocol(asyncio.Protocol):
+	'''
+	Handles one client connection. The cache holds (flags, data, cas)
+	tuples so gets can send back the flags and cas unique the value was
+	stored with.
+
+	>>> server = MemcachedServer(Cache(max_size=10))
+	>>> protocol = MemcachedProtocol(server)
+	>>> protocol.handle(b'set k 0 0 2\\r\\nhi\\r\\ngets k\\r\\ndelete k\\r\\nget k\\r\\n')
+	b'STORED\\r\\nVALUE k 0 2 1\\r\\nhi\\r\\nEND\\r\\nDELETED\\r\\nEND\\r\\n'
+
+	Partial commands are held on to until the rest of them shows up:
+
+	>>> protocol.handle(b'set k 0 0 5\\r\\nhel')
+	b''
+	>>> protocol.handle(b'lo\\r\\nget k\\r\\n')
+	b'STORED\\r\\nVALUE k 0 5\\r\\nhello\\r\\nEND\\r\\n'
+	>>> protocol.handle(b'set k 0 0 1 noreply\\r\\nx\\r\\nfrob\\r\\n')
+	b'ERROR\\r\\n'
+
+	Data blocks have to be exactly as long as the set said they'd be:
+
+	>>> protocol.handle(b'set k 0 0 -1\\r\\nget k\\r\\n')
+	b'CLIENT_ERROR bad command line format\\r\\nVALUE k 0 1\\r\\nx\\r\\nEND\\r\\n'
+	>>> protocol.handle(b'set k 0 0 2\\r\\nhello\\r\\nget k\\r\\n')
+	b'CLIENT_ERROR bad data chunk\\r\\nVALUE k 0 1\\r\\nx\\r\\nEND\\r\\n'
+	'''
+
+	def __init__(self, server):
+		self.server = server
+		self.buffer = bytearray()
+		self.transport = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+		self.server.stats['total_connections'] += 1
+		self.server.stats['curr_connections'] += 1
+
+	def connection_lost(self, exc):
+		self.server.stats['curr_connections'] -= 1
+
+	def data_received(self, data):
+		replies = self.handle(data)
+		if replies:
+			self.transport.write(replies)
+
+	def handle(self, data):
+		'''
+		Adds data to what's been read so far, runs every complete command
+		in it and returns all of their replies joined together.
+		'''
+		self.buffer.extend(data)
+		replies = list()
+		while True:
+			end = self.buffer.find(b'\r\n')
+			if end < 0:
+				break
+			fields = bytes(self.buffer[:end]).split()
+			consumed = end + 2
+			if fields and fields[0] == b'set':
+				try:
+					length = int(fields[4])
+				except (IndexError, ValueError):
+					length = -1
+				if length < 0:
+					replies.append(b'CLIENT_ERROR bad command line format\r\n')
+					del self.buffer[:consumed]
+					continue
+				if len(self.buffer) < consumed + length + 2:
+					# Wait for the rest of the data block.
+					break
+				data_block = bytes(self.buffer[consumed:consumed + length])
+				if self.buffer[consumed + length:consumed + length + 2] == b'\r\n':
+					consumed = consumed + length + 2
+					reply = self.server.set(fields, data_block)
+				else:
+					# The block was longer than it said it was. Throw the
+					# rest of it away up to the end of its line.
+					end = self.buffer.find(b'\r\n', consumed + length)
+					if end < 0:
+						break
+					consumed = end + 2
+					reply = b'CLIENT_ERROR bad data chunk\r\n'
+			else:
+				reply = self.server.command(fields)
+			del self.buffer[:consumed]
+			if reply:
+				replies.append(reply)
+		return b''.join(replies)
+
+class MemcachedServer():
+	'''
+	The state shared by every connection: the cache, the cas unique
+	counter and the stats counters. The cache can be a Cache or a
+	ShardedCache.
+
+	A byte budgeted Cache using the default weigher would only weigh the
+	(flags, data, cas) tuples the server stores, not the data in them,
+	so it's switched over to stored_weigher().
+
+	>>> server = MemcachedServer(Cache(max_bytes=1000))
+	>>> server.set([b'set', b'k', b'0', b'0', b'5000'], b'x' * 5000)
+	b'SERVER_ERROR object too large for cache\\r\\n'
+	>>> server.command([b'stats']).count(b'STAT curr_items 0')
+	1
+	'''
+
+	def __init__(self, cache):
+		if getattr(cache, 'weigher', None) is getsizeof_weigher:
+			cache.weigher = stored_weigher
+		self.cache = cache
+		self.cas = itertools.count(1)
+		self.started = time.time()
+		self.stats = dict.fromkeys(('cmd_get', 'cmd_set', 'get_hits', 'get_misses',
+			'delete_hits', 'delete_misses', 'total_connections', 'curr_connections'), 0)
+
+	def command(self, fields):
+		if not fields:
+			return b'ERROR\r\n'
+		name = fields[0]
+		if name in (b'get', b'gets') and len(fields) > 1:
+			return self.get(fields[1:], cas=name == b'gets')
+		if name == b'delete' and len(fields) > 1:
+			if self.cache.delete(fields[1]):
+				self.stats['delete_hits'] += 1
+				reply = b'DELETED\r\n'
+			else:
+				self.stats['delete_misses'] += 1
+				reply = b'NOT_FOUND\r\n'
+			return b'' if fields[-1] == b'noreply' else reply
+		if name == b'stats':
+			return self.stats_reply()
+		return b'ERROR\r\n'
+
+	def get(self, keys, cas=False):
+		reply = list()
+		for key in keys:
+			self.stats['cmd_get'] += 1
+			stored = self.cache.get(key)
+			if stored is None:
+				self.stats['get_misses'] += 1
+				continue
+			self.stats['get_hits'] += 1
+			flags, data, unique = stored
+			if cas:
+				reply.append(b'VALUE %s %d %d %d\r\n' % (key, flags, len(data), unique))
+			else:
+				reply.append(b'VALUE %s %d %d\r\n' % (key, flags, len(data)))
+			reply.append(data)
+			reply.append(b'\r\n')
+		reply.append(b'END\r\n')
+		return b''.join(reply)
+
+	def set(self, fields, data):
+		self.stats['cmd_set'] += 1
+		try:
+			key = fields[1]
+			flags = int(fields[2])
+			exptime = int(fields[3])
+		except (IndexError, ValueError):
+			return b'CLIENT_ERROR bad command line format\r\n'
+		ttl = None
+		if exptime > RELATIVE_EXPTIME_LIMIT:
+			ttl = exptime - time.time()
+		elif exptime > 0:
+			ttl = exptime
+		elif exptime < 0:
+			ttl = 0
+		try:
+			self.cache.put(key, (flags, data, next(self.cas)), ttl)
+		except ValueError:
+			reply = b'SERVER_ERROR object too large for cache\r\n'
+		else:
+			reply = b'STORED\r\n'
+		return b'' if fields[-1] == b'noreply' else reply
+
+	def stats_reply(self):
+		stats = [('pid', os.getpid()), ('uptime', int(time.time() - self.started)),
+			('curr_items', len(self.cache))] + sorted(self.stats.items())
+		lines = [b'STAT %s %d\r\n' % (name.encode(), value) for name, value in stats]
+		return b''.join(lines) + b'END\r\n'
+
+async def start_server(cache, host='127.0.0.1', port=11211, path=None):
+	'''
+	Serves cache on a TCP host and port, or on a Unix socket if path is
+	given. Returns the asyncio server.
+	'''
+	server = MemcachedServer(cache)
+	loop = asyncio.get_running_loop()
+	if path is not None:
+		return await loop.create_unix_server(lambda: MemcachedProtocol(server), path)
+	return await loop.create_server(lambda: MemcachedProtocol(server), host, port)
+
+class ServerThread(threading.Thread):
+	'''
+	Runs start_server() on an event loop of its own in a daemon thread,
+	so blocking code in the same process, like a memcached.ClusterClient,
+	can talk to it. address is the (host, port) it's listening on.
+
+	A ClusterClient over a few of them moves about a quarter of the keys
+	when a fourth server joins three:
+
+	>>> import functools
+	>>> from memcached import ClusterClient, MemcachedConnection, benchmark_cluster
+	>>> servers = [ServerThread(Cache(max_size=1000)) for i in range(4)]
+	>>> for server in servers:
+	...     server.start()
+	>>> nodes = [functools.partial(MemcachedConnection, *server.address) for server in servers]
+	>>> client = ClusterClient(dict(enumerate(nodes[:3])))
+	>>> for key in range(300):
+	...     client.put(key, key * key)
+	>>> client.get_many([2, 3, 'missing'])
+	{2: 4, 3: 9}
+	>>> client.add_node(3, nodes[3])
+	>>> 30 < 300 - len(client.get_many(range(300))) < 120
+	True
+	>>> client.close()
+	>>> results = benchmark_cluster(nodes=3, keys=300, connect=lambda name: nodes[name])
+	>>> 0.1 < results['moved'] < 0.4
+	True
+	>>> for server in servers:
+	...     server.stop()
+	'''
+
+	def __init__(self, cache, host='127.0.0.1', port=0):
+		threading.Thread.__init__(self)
+		self.daemon = True
+		self.loop = asyncio.new_event_loop()
+		self.server = self.loop.run_until_complete(start_server(cache, host, port))
+		self.address = self.server.sockets[0].getsockname()[:2]
+
+	def run(self):
+		self.loop.run_forever()
+
+	def stop(self):
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.join()
+		self.server.close()
+		self.loop.run_until_complete(self.server.wait_closed())
+		self.loop.close()
+
+async def load(host='127.0.0.1', port=11211, clients=8, requests=10000, pipeline=16, keys=1000, size=100):
+	'''
+	A load generator for any memcached speaking server, ours or a stock
+	memcached. It sets keys values of size bytes and then has clients
+	connections each send requests gets in pipelined batches. Returns a
+	dict with the requests/sec and the p50 and p99 latency of a batch in
+	milliseconds.
+
+	>>> async def demo():
+	...     server = await start_server(Cache(max_size=100), port=0)
+	...     port = server.sockets[0].getsockname()[1]
+	...     results = await load(port=port, clients=2, requests=200, keys=50)
+	...     server.close()
+	...     await server.wait_closed()
+	...     return results
+	>>> sorted(asyncio.run(demo()).keys())
+	['p50_ms', 'p99_ms', 'requests_per_sec']
+	'''
+	value = b'x' * size
+	reader, writer = await asyncio.open_connection(host, port)
+	for key in range(keys):
+		writer.write(b'set key%d 0 0 %d noreply\r\n%s\r\n' % (key, size, value))
+	writer.write(b'get key0\r\n')
+	await reader.readuntil(b'END\r\n')
+	writer.close()
+
+	latencies = list()
+	async def client(number):
+		reader, writer = await asyncio.open_connection(host, port)
+		for batch in range(0, requests, pipeline):
+			count = min(pipeline, requests - batch)
+			commands = [b'get key%d\r\n' % ((number * requests + batch + i) % keys) for i in range(count)]
+			start = time.perf_counter()
+			writer.write(b''.join(commands))
+			for i in range(count):
+				await reader.readuntil(b'END\r\n')
+			latencies.append(time.perf_counter() - start)
+		writer.close()
+
+	start = time.perf_counter()
+	await asyncio.gather(*[client(number) for number in range(clients)])
+	elapsed = time.perf_counter() - start
+	latencies.sort()
+	return {
+		'requests_per_sec': clients * requests / elapsed,
+		'p50_ms': latencies[len(latencies) // 2] * 1000,
+		'p99_ms': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000,
+	}
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -0,0 +1,441 @@
+#!/bin/env python3
+
+'''
+memcached_shm
+
+A cache kept in a multiprocessing.shared_memory block, so all the
+workers of a pre-forked server share one cache instead of each keeping
+its own Cache. It's Python 3 only, unlike the Cache itself.
+
+There are no Python objects in the block. It's laid out as int64 words
+followed by a byte arena:
+
+    header      counters and the heads of the LRU and free entry lists
+    free lists  the first free chunk of each slab class
+    table       an open addressing hash table of entry numbers
+    entries     capacity records of ENTRY_FIELDS words each
+    arena       pages of slab chunks holding pickled keys and values
+
+The table is probed linearly and deletes shift the entries after them
+back, so it never fills up with tombstones. The entries are chained
+into the LRU list by their numbers instead of by pointers, and the free
+entries are chained through the same newer field. The arena is split up
+the way memcached does it: a page goes to a slab class the first time
+that class needs room, and the page is cut into chunks of that class's
+size. A chunk holds one pickled key followed by its pickled value. Once
+every page has been handed out a class that's out of chunks evicts its
+own least recently used entry, so pages stay with the class that first
+carved them.
+
+Keys are hashed and compared by their pickles. I use crc32 instead of
+hash() because hash() of a str isn't the same in processes that don't
+share a PYTHONHASHSEED. It also means 1 and 1.0 are different keys here
+where they're the same key in a Cache.
+
+One multiprocessing.Lock guards the whole block. A worker gets it either
+by being forked after the cache is made or by having the cache passed
+to it when it's started. Either way it ends up with the same get()/put()
+API a Cache has.
+
+>>> cache = SharedCache(capacity=100, arena_bytes=1 << 16, page_size=1 << 12)
+>>> cache.put('a', [1, 2, 3])
+>>> def worker(cache):
+...     cache.put('b', cache.get('a') + [4])
+>>> process = multiprocessing.get_context('fork').Process(target=worker, args=(cache,))
+>>> process.start(); process.join()
+>>> cache.get('b')
+[1, 2, 3, 4]
+>>> len(cache)
+2
+>>> cache.close()
+>>> cache.unlink()
+'''
+
+import multiprocessing
+import pickle
+import random
+import struct
+import time
+import zlib
+from multiprocessing import shared_memory
+
+MAGIC = 0x4c52555348415245
+EMPTY = -1
+PROTOCOL = pickle.HIGHEST_PROTOCOL
+MIN_CHUNK = 64
+
+(H_MAGIC, H_CAPACITY, H_TABLE_SIZE, H_PAGE_SIZE, H_PAGES, H_CLASSES, H_COUNT,
+	H_NEWEST, H_OLDEST, H_FREE_ENTRY, H_NEXT_PAGE, H_HITS, H_MISSES, H_EVICTIONS) = range(14)
+HEADER_FIELDS = 16
+
+(E_HASH, E_CHUNK, E_KEY_LENGTH, E_VALUE_LENGTH, E_EXPIRES, E_OLDER, E_NEWER,
+	E_CLASS, E_SLOT) = range(9)
+ENTRY_FIELDS = 9
+
+class SharedCache():
+	'''
+	An LRU cache of up to capacity keys with arena_bytes of room for
+	them and their values. The largest key and value that can be stored
+	together is page_size bytes once they're pickled. Workers that are
+	started with something other than the default multiprocessing
+	context need a lock made by that context passed in as lock.
+
+	>>> c = SharedCache(capacity=3, arena_bytes=1 << 12, page_size=1 << 10)
+	>>> for key in (1, 2, 3):
+	...     c.put(key, str(key))
+	>>> c.get(1)
+	'1'
+	>>> c.put(4, '4')
+	>>> [c.get(key) for key in (1, 2, 3, 4)]
+	['1', None, '3', '4']
+	>>> c.put(3, 'three')
+	>>> c.get(3), len(c)
+	('three', 3)
+	>>> c.delete(3), c.delete(3)
+	(True, False)
+	>>> c.put(5, 'x' * 2000)
+	Traceback (most recent call last):
+	...
+	ValueError: 2023 bytes won't fit in a 1024 byte page
+	>>> c.put(5, 'five', ttl=-1)
+	>>> c.get(5)
+	>>> sorted(c.stats().items())
+	[('evictions', 1), ('hits', 5), ('items', 2), ('misses', 2)]
+	>>> c.close()
+	>>> c.unlink()
+
+	Values that only fit in the same slab class as the ones already
+	stored push the least recently used of those out once the arena's
+	pages have all been given out:
+
+	>>> c = SharedCache(capacity=100, arena_bytes=1 << 10, page_size=1 << 9)
+	>>> for key in range(10):
+	...     c.put(key, 'x' * 200)
+	>>> len(c), c.get(0), c.get(9) == 'x' * 200
+	(4, None, True)
+	>>> c.close()
+	>>> c.unlink()
+	'''
+
+	def __init__(self, capacity=1024, arena_bytes=1 << 24, page_size=1 << 16, lock=None):
+		if page_size < MIN_CHUNK or page_size & (page_size - 1):
+			raise ValueError('page_size has to be a power of two of at least %d' % MIN_CHUNK)
+		pages = arena_bytes // page_size
+		if pages < 1:
+			raise ValueError('arena_bytes has to hold at least one page')
+		classes = (page_size // MIN_CHUNK).bit_length()
+		table_size = 1 << (2 * capacity - 1).bit_length()
+		words = HEADER_FIELDS + classes + table_size + capacity * ENTRY_FIELDS
+		self.memory = shared_memory.SharedMemory(create=True, size=words * 8 + pages * page_size)
+		self.lock = multiprocessing.Lock() if lock is None else lock
+		header = [0] * HEADER_FIELDS
+		header[H_MAGIC] = MAGIC
+		header[H_CAPACITY] = capacity
+		header[H_TABLE_SIZE] = table_size
+		header[H_PAGE_SIZE] = page_size
+		header[H_PAGES] = pages
+		header[H_CLASSES] = classes
+		header[H_NEWEST] = header[H_OLDEST] = EMPTY
+		struct.pack_into('%dq' % HEADER_FIELDS, self.memory.buf, 0, *header)
+		self._map()
+		words = self.words
+		for i in range(self.free_lists, self.entries):
+			words[i] = EMPTY
+		for number in range(capacity):
+			words[self.entries + number * ENTRY_FIELDS + E_NEWER] = number + 1
+		words[self.entries + (capacity - 1) * ENTRY_FIELDS + E_NEWER] = EMPTY
+
+	@classmethod
+	def attach(cls, name, lock):
+		'''
+		Opens the SharedCache some other process made in the shared
+		memory block called name. lock has to be the lock that cache was
+		made with.
+		'''
+		self = cls.__new__(cls)
+		self.__setstate__((name, lock))
+		return self
+
+	def __getstate__(self):
+		return self.memory.name, self.lock
+
+	def __setstate__(self, state):
+		name, self.lock = state
+		self.memory = shared_memory.SharedMemory(name=name)
+		self._map()
+
+	def _map(self):
+		buf = self.memory.buf
+		header = struct.unpack_from('%dq' % HEADER_FIELDS, buf, 0)
+		if header[H_MAGIC] != MAGIC:
+			raise ValueError('%s is not a SharedCache' % self.memory.name)
+		self.capacity = header[H_CAPACITY]
+		self.table_size = header[H_TABLE_SIZE]
+		self.page_size = header[H_PAGE_SIZE]
+		self.pages = header[H_PAGES]
+		self.free_lists = HEADER_FIELDS
+		self.table = self.free_lists + header[H_CLASSES]
+		self.entries = self.table + self.table_size
+		end = (self.entries + self.capacity * ENTRY_FIELDS) * 8
+		self.words = buf[:end].cast('q')
+		self.arena = buf[end:end + self.pages * self.page_size]
+
+	def close(self):
+		'''
+		Lets go of this process's view of the cache. Every process that
+		opened it should close it, and then one of them should unlink it.
+		'''
+		self.words.release()
+		self.arena.release()
+		self.memory.close()
+
+	def unlink(self):
+		self.memory.unlink()
+
+	def __len__(self):
+		return self.words[H_COUNT]
+
+	def stats(self):
+		words = self.words
+		return {
+			'items': words[H_COUNT],
+			'hits': words[H_HITS],
+			'misses': words[H_MISSES],
+			'evictions': words[H_EVICTIONS],
+		}
+
+	def put(self, key, value, ttl=None):
+		key_bytes = pickle.dumps(key, PROTOCOL)
+		value_bytes = pickle.dumps(value, PROTOCOL)
+		code = zlib.crc32(key_bytes)
+		size = len(key_bytes) + len(value_bytes)
+		if size > self.page_size:
+			raise ValueError("%d bytes won't fit in a %d byte page" % (size, self.page_size))
+		size_class = ((size - 1) // MIN_CHUNK).bit_length()
+		expires = 0 if ttl is None else int((time.time() + ttl) * 1000000)
+		words = self.words
+		with self.lock:
+			slot, number = self._find(key_bytes, code)
+			if number != EMPTY:
+				base = self.entries + number * ENTRY_FIELDS
+				if words[base + E_CLASS] == size_class:
+					# The new value fits in the old one's chunk.
+					self._unlink(number)
+				else:
+					self._remove(number)
+					number = EMPTY
+			if number == EMPTY:
+				chunk = self._allocate(size_class)
+				number = self._new_entry()
+				slot, found = self._find(key_bytes, code)
+				base = self.entries + number * ENTRY_FIELDS
+				words[self.table + slot] = number
+				words[base + E_SLOT] = slot
+				words[base + E_HASH] = code
+				words[base + E_CHUNK] = chunk
+				words[base + E_CLASS] = size_class
+				words[H_COUNT] += 1
+			chunk = words[base + E_CHUNK]
+			middle = chunk + len(key_bytes)
+			self.arena[chunk:middle] = key_bytes
+			self.arena[middle:chunk + size] = value_bytes
+			words[base + E_KEY_LENGTH] = len(key_bytes)
+			words[base + E_VALUE_LENGTH] = len(value_bytes)
+			words[base + E_EXPIRES] = expires
+			self._link_newest(number)
+
+	def get(self, key):
+		key_bytes = pickle.dumps(key, PROTOCOL)
+		code = zlib.crc32(key_bytes)
+		words = self.words
+		with self.lock:
+			slot, number = self._find(key_bytes, code)
+			if number == EMPTY:
+				words[H_MISSES] += 1
+				return None
+			base = self.entries + number * ENTRY_FIELDS
+			expires = words[base + E_EXPIRES]
+			if expires and expires <= time.time() * 1000000:
+				self._remove(number)
+				words[H_MISSES] += 1
+				return None
+			words[H_HITS] += 1
+			self._unlink(number)
+			self._link_newest(number)
+			start = words[base + E_CHUNK] + words[base + E_KEY_LENGTH]
+			data = bytes(self.arena[start:start + words[base + E_VALUE_LENGTH]])
+		return pickle.loads(data)
+
+	def delete(self, key):
+		key_bytes = pickle.dumps(key, PROTOCOL)
+		with self.lock:
+			slot, number = self._find(key_bytes, zlib.crc32(key_bytes))
+			if number == EMPTY:
+				return False
+			self._remove(number)
+			return True
+
+	def _find(self, key_bytes, code):
+		'''
+		Returns the table slot key_bytes is in and its entry number, or
+		the empty slot it would go in and EMPTY. The table is always at
+		least half empty so the probing always stops.
+		'''
+		words = self.words
+		mask = self.table_size - 1
+		length = len(key_bytes)
+		slot = code & mask
+		while True:
+			number = words[self.table + slot]
+			if number == EMPTY:
+				return slot, EMPTY
+			base = self.entries + number * ENTRY_FIELDS
+			if words[base + E_HASH] == code and words[base + E_KEY_LENGTH] == length:
+				chunk = words[base + E_CHUNK]
+				if self.arena[chunk:chunk + length] == key_bytes:
+					return slot, number
+			slot = (slot + 1) & mask
+
+	def _new_entry(self):
+		words = self.words
+		if words[H_FREE_ENTRY] == EMPTY:
+			self._remove(words[H_OLDEST], evicted=True)
+		number = words[H_FREE_ENTRY]
+		words[H_FREE_ENTRY] = words[self.entries + number * ENTRY_FIELDS + E_NEWER]
+		return number
+
+	def _allocate(self, size_class):
+		words = self.words
+		head = self.free_lists + size_class
+		if words[head] == EMPTY:
+			if words[H_NEXT_PAGE] < self.pages:
+				self._carve(size_class)
+			else:
+				self._evict_class(size_class)
+		chunk = words[head]
+		words[head] = struct.unpack_from('q', self.arena, chunk)[0]
+		return chunk
+
+	def _carve(self, size_class):
+		'''
+		Hands the next unused page to size_class and puts its chunks on
+		the class's free list.
+		'''
+		words = self.words
+		head = self.free_lists + size_class
+		start = words[H_NEXT_PAGE] * self.page_size
+		words[H_NEXT_PAGE] += 1
+		chunk_size = MIN_CHUNK << size_class
+		for chunk in range(start + self.page_size - chunk_size, start - 1, -chunk_size):
+			struct.pack_into('q', self.arena, chunk, words[head])
+			words[head] = chunk
+
+	def _evict_class(self, size_class):
+		words = self.words
+		number = words[H_OLDEST]
+		while number != EMPTY:
+			base = self.entries + number * ENTRY_FIELDS
+			if words[base + E_CLASS] == size_class:
+				self._remove(number, evicted=True)
+				return
+			number = words[base + E_NEWER]
+		raise ValueError('no pages are left for %d byte chunks' % (MIN_CHUNK << size_class))
+
+	def _remove(self, number, evicted=False):
+		words = self.words
+		base = self.entries + number * ENTRY_FIELDS
+		self._clear_slot(words[base + E_SLOT])
+		self._unlink(number)
+		head = self.free_lists + words[base + E_CLASS]
+		struct.pack_into('q', self.arena, words[base + E_CHUNK], words[head])
+		words[head] = words[base + E_CHUNK]
+		words[base + E_NEWER] = words[H_FREE_ENTRY]
+		words[H_FREE_ENTRY] = number
+		words[H_COUNT] -= 1
+		if evicted:
+			words[H_EVICTIONS] += 1
+
+	def _clear_slot(self, hole):
+		'''
+		Empties a table slot and shifts back any entries after it that
+		would no longer be found past the gap.
+		'''
+		words = self.words
+		mask = self.table_size - 1
+		slot = (hole + 1) & mask
+		while True:
+			number = words[self.table + slot]
+			if number == EMPTY:
+				break
+			base = self.entries + number * ENTRY_FIELDS
+			home = words[base + E_HASH] & mask
+			if (slot - home) & mask >= (slot - hole) & mask:
+				words[self.table + hole] = number
+				words[base + E_SLOT] = hole
+				hole = slot
+			slot = (slot + 1) & mask
+		words[self.table + hole] = EMPTY
+
+	def _unlink(self, number):
+		words = self.words
+		base = self.entries + number * ENTRY_FIELDS
+		older = words[base + E_OLDER]
+		newer = words[base + E_NEWER]
+		if older == EMPTY:
+			words[H_OLDEST] = newer
+		else:
+			words[self.entries + older * ENTRY_FIELDS + E_NEWER] = newer
+		if newer == EMPTY:
+			words[H_NEWEST] = older
+		else:
+			words[self.entries + newer * ENTRY_FIELDS + E_OLDER] = older
+
+	def _link_newest(self, number):
+		words = self.words
+		base = self.entries + number * ENTRY_FIELDS
+		newest = words[H_NEWEST]
+		words[base + E_OLDER] = newest
+		words[base + E_NEWER] = EMPTY
+		if newest == EMPTY:
+			words[H_OLDEST] = number
+		else:
+			words[self.entries + newest * ENTRY_FIELDS + E_NEWER] = number
+		words[H_NEWEST] = number
+
+def benchmark(workers=4, ops=100000, keys=10000, size=100):
+	'''
+	Has workers forked processes each do ops random gets against one
+	SharedCache, putting a value of size bytes on every miss. Returns
+	the hit rate and the gets/sec across all of them.
+
+	>>> results = benchmark(workers=2, ops=2000, keys=100)
+	>>> sorted(results.keys())
+	['gets_per_sec', 'hit_rate']
+	'''
+	cache = SharedCache(capacity=keys, arena_bytes=max(1 << 20, keys * size * 4))
+	value = b'x' * size
+	def worker(seed):
+		generator = random.Random(seed)
+		for i in range(ops):
+			key = generator.randrange(keys)
+			if cache.get(key) is None:
+				cache.put(key, value)
+	context = multiprocessing.get_context('fork')
+	processes = [context.Process(target=worker, args=(seed,)) for seed in range(workers)]
+	start = time.perf_counter()
+	for process in processes:
+		process.start()
+	for process in processes:
+		process.join()
+	elapsed = time.perf_counter() - start
+	stats = cache.stats()
+	cache.close()
+	cache.unlink()
+	return {
+		'hit_rate': stats['hits'] / float(stats['hits'] + stats['misses']),
+		'gets_per_sec': workers * ops / elapsed,
+	}
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
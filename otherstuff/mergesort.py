@@ -10,6 +10,14 @@ Sort arrays using the mergesort approach to sorting. For example:
 
 '''
 
+import bisect
+import heapq
+import random
+import time
+
+# Runs this short or shorter are insertion sorted before they're merged.
+INSERTION_SORT_SIZE = 32
+
 def mergesort(array):
 	'''
 	Sorts an array using the mergesort algorithm. Returns the sorted
@@ -31,7 +39,7 @@ def mergesort(array):
 	if len(array) <= 1:
 		return array
 	else:
-		return _merge(mergesort(array[:len(array)/2]), mergesort(array[len(array)/2:]))
+		return _merge(mergesort(array[:len(array)//2]), mergesort(array[len(array)//2:]))
 
 def _merge(left, right):
 	'''
@@ -80,6 +88,469 @@ def _merge(left, right):
 		merged_array = merged_array + right[right_index:]
 	return merged_array
 
+def bottom_up_mergesort(array):
+	'''
+	Sorts an array with an iterative, bottom up mergesort and returns
+	the sorted array as a new list, leaving array alone. It's stable,
+	like mergesort().
+
+	mergesort() slices the array in half at every level of recursion
+	and _merge() builds a new list for every merge, so it allocates
+	O(N log N) worth of lists. This makes one copy of the array and one
+	buffer the same size. The array is cut into runs of
+	INSERTION_SORT_SIZE that are insertion sorted in place, then each
+	pass merges pairs of runs from one list in to the other and the two
+	swap places for the next pass, with the runs doubling in length
+	each time.
+
+	>>> bottom_up_mergesort([])
+	[]
+	>>> bottom_up_mergesort([1])
+	[1]
+	>>> bottom_up_mergesort([3,1,2])
+	[1, 2, 3]
+	>>> bottom_up_mergesort([1, 10 , 9, 15, 2, -1, 12, 4, 100, 101])
+	[-1, 1, 2, 4, 9, 10, 12, 15, 100, 101]
+	>>> array = [random.randrange(50) for i in range(1000)]
+	>>> bottom_up_mergesort(array) == sorted(array)
+	True
+
+	Equal items keep the order they came in:
+
+	>>> pairs = [(random.randrange(10), i) for i in range(1000)]
+	>>> [i for key, i in bottom_up_mergesort([(key, i) for key, i in pairs])] == [i for key, i in sorted(pairs)]
+	True
+	'''
+	source = list(array)
+	size = len(source)
+	run = INSERTION_SORT_SIZE
+	for start in range(0, size, run):
+		_insertion_sort(source, start, min(start + run, size))
+	target = [None] * size
+	while run < size:
+		for start in range(0, size, 2 * run):
+			_merge_into(source, target, start, min(start + run, size), min(start + 2 * run, size))
+		source, target = target, source
+		run = run * 2
+	return source
+
+def _insertion_sort(array, start, end):
+	'''
+	Sorts array[start:end] in place. Each item is inserted after any
+	items equal to it so the sort is stable.
+
+	>>> array = [9, 3, 2, 1, 0]
+	>>> _insertion_sort(array, 1, 4)
+	>>> array
+	[9, 1, 2, 3, 0]
+	'''
+	for i in range(start + 1, end):
+		item = array[i]
+		where = bisect.bisect_right(array, item, start, i)
+		if where < i:
+			array[where + 1:i + 1] = array[where:i]
+			array[where] = item
+
+def _merge_into(source, target, start, middle, end):
+	'''
+	Merges the sorted runs source[start:middle] and source[middle:end]
+	in to target[start:end]. Runs that are already in order, which is
+	common on partly sorted input, are copied straight across.
+
+	>>> target = [0] * 5
+	>>> _merge_into([1, 4, 2, 3, 5], target, 0, 2, 5)
+	>>> target
+	[1, 2, 3, 4, 5]
+	'''
+	if middle >= end or not source[middle] < source[middle - 1]:
+		target[start:end] = source[start:end]
+		return
+	left = start
+	right = middle
+	index = start
+	# Hang on to the two items at the front so each step only has to
+	# index source for the one that was taken.
+	left_item = source[left]
+	right_item = source[right]
+	while True:
+		if right_item < left_item:
+			target[index] = right_item
+			index = index + 1
+			right = right + 1
+			if right == end:
+				break
+			right_item = source[right]
+		else:
+			target[index] = left_item
+			index = index + 1
+			left = left + 1
+			if left == middle:
+				break
+			left_item = source[left]
+	if left < middle:
+		target[index:end] = source[left:middle]
+	else:
+		target[index:end] = source[right:end]
+
+# The number of times in a row one side of a merge has to win before
+# the merge starts galloping.
+MIN_GALLOP = 7
+
+def adaptive_mergesort(array, key=None):
+	'''
+	Sorts an array with a mergesort that takes advantage of any order
+	that's already in it, and returns the sorted array as a new list.
+	It's stable, and items are compared by key(item) if key is given.
+
+	The array is split in to natural runs: stretches that are already
+	ascending, or strictly descending ones, which are reversed in
+	place. Runs shorter than _min_run() are padded out with an
+	insertion sort. The runs go on a stack that's merged as it's built
+	so each run on it is longer than the two above it put together,
+	the way timsort does it, which keeps the merges balanced. So input
+	that's already sorted is one run and takes N - 1 comparisons, and
+	a log appended to out of order in a few places is only a handful of
+	merges.
+
+	>>> adaptive_mergesort([])
+	[]
+	>>> adaptive_mergesort([1, 10 , 9, 15, 2, -1, 12, 4, 100, 101])
+	[-1, 1, 2, 4, 9, 10, 12, 15, 100, 101]
+	>>> adaptive_mergesort(['bb', 'a', 'ccc', 'dd'], key=len)
+	['a', 'bb', 'dd', 'ccc']
+	>>> array = [random.randrange(1000) for i in range(5000)]
+	>>> adaptive_mergesort(array) == sorted(array)
+	True
+	>>> pairs = [(random.randrange(10), i) for i in range(1000)]
+	>>> adaptive_mergesort(pairs, key=lambda pair: pair[0]) == sorted(pairs, key=lambda pair: pair[0])
+	True
+
+	Counting the comparisons:
+
+	>>> class Counted(object):
+	...     count = 0
+	...     def __init__(self, value):
+	...         self.value = value
+	...     def __lt__(self, other):
+	...         Counted.count = Counted.count + 1
+	...         return self.value < other.value
+	>>> result = adaptive_mergesort([Counted(i) for i in range(1000)])
+	>>> Counted.count
+	999
+	>>> Counted.count = 0
+	>>> result = adaptive_mergesort([Counted(i) for i in range(1000, 0, -1)])
+	>>> Counted.count
+	999
+	'''
+	if key is not None:
+		# Tuples compare by key and then by position, so the items
+		# themselves are never compared and ties keep their order.
+		decorated = [(key(item), index, item) for index, item in enumerate(array)]
+		return [item for item_key, index, item in adaptive_mergesort(decorated)]
+	array = list(array)
+	size = len(array)
+	min_run = _min_run(size)
+	runs = list() # Stack of (start, length) of runs waiting to be merged
+	start = 0
+	while start < size:
+		end = start + 1
+		if end < size:
+			descending = array[end] < array[start]
+			end = end + 1
+			if descending:
+				while end < size and array[end] < array[end - 1]:
+					end = end + 1
+				array[start:end] = array[start:end][::-1]
+			else:
+				while end < size and not array[end] < array[end - 1]:
+					end = end + 1
+		if end - start < min_run:
+			end = min(start + min_run, size)
+			_insertion_sort(array, start, end)
+		runs.append((start, end - start))
+		_merge_collapse(array, runs)
+		start = end
+	while len(runs) > 1:
+		n = len(runs) - 2
+		if n > 0 and runs[n - 1][1] < runs[n + 1][1]:
+			n = n - 1
+		_merge_at(array, runs, n)
+	return array
+
+def _min_run(size):
+	'''
+	Returns the shortest run worth merging for an array of size items,
+	somewhere between 32 and 64, picked so size / min_run is a power of
+	two or just under one and the merges come out balanced.
+
+	>>> _min_run(63), _min_run(64), _min_run(65), _min_run(2112)
+	(63, 32, 33, 33)
+	'''
+	extra = 0
+	while size >= 64:
+		extra = extra | (size & 1)
+		size = size >> 1
+	return size + extra
+
+def _merge_collapse(array, runs):
+	'''
+	Merges runs on the top of the stack until, from the top down, each
+	is shorter than the one below it and the two below it add up to
+	less than the one below them.
+	'''
+	while len(runs) > 1:
+		n = len(runs) - 2
+		if (n > 0 and runs[n - 1][1] <= runs[n][1] + runs[n + 1][1]) or (n > 1 and runs[n - 2][1] <= runs[n - 1][1] + runs[n][1]):
+			if runs[n - 1][1] < runs[n + 1][1]:
+				n = n - 1
+		elif runs[n][1] > runs[n + 1][1]:
+			break
+		_merge_at(array, runs, n)
+
+def _merge_at(array, runs, n):
+	'''
+	Merges runs n and n + 1 on the stack, which sit side by side in
+	array. The front of the left run that's no bigger than the start of
+	the right run is already in place, and so is the back of the right
+	run that's bigger than the end of the left run, so they're galloped
+	past and left out of the merge.
+	'''
+	start, length = runs[n]
+	middle = start + length
+	end = middle + runs[n + 1][1]
+	runs[n] = (start, end - start)
+	del(runs[n + 1])
+	start = _gallop_right(array[middle], array, start, middle)
+	end = _gallop_left(array[middle - 1], array, middle, end)
+	if start < middle < end:
+		_gallop_merge(array, start, middle, end)
+
+def _gallop_right(item, array, low, high):
+	'''
+	Returns where item would go in the sorted array[low:high] after any
+	items equal to it. It looks at low, low + 1, low + 3, low + 7 and so
+	on until it passes item and then bisects the last step, so it's
+	O(log d) where d is how far in the answer is.
+
+	>>> _gallop_right(3, [1, 2, 3, 3, 4, 5], 0, 6)
+	4
+	'''
+	step = 1
+	while True:
+		probe = low + step - 1
+		if probe >= high:
+			return bisect.bisect_right(array, item, low, high)
+		if item < array[probe]:
+			return bisect.bisect_right(array, item, low, probe)
+		low = probe + 1
+		step = step * 2
+
+def _gallop_left(item, array, low, high):
+	'''
+	Like _gallop_right() but returns where item would go before any
+	items equal to it.
+
+	>>> _gallop_left(3, [1, 2, 3, 3, 4, 5], 0, 6)
+	2
+	'''
+	step = 1
+	while True:
+		probe = low + step - 1
+		if probe >= high:
+			return bisect.bisect_left(array, item, low, high)
+		if not array[probe] < item:
+			return bisect.bisect_left(array, item, low, probe)
+		low = probe + 1
+		step = step * 2
+
+def _gallop_merge(array, start, middle, end):
+	'''
+	Merges the sorted runs array[start:middle] and array[middle:end] in
+	place, with only the left run copied out. It merges an item at a
+	time like _merge() until one side wins MIN_GALLOP times in a row,
+	then switches to galloping: finding how many items in a row each
+	side wins with _gallop_right() and _gallop_left() and copying them
+	as a block. It goes back to an item at a time once neither side is
+	winning long stretches.
+
+	>>> array = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 0, 11]
+	>>> _gallop_merge(array, 0, 10, 12)
+	>>> array
+	[0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
+	'''
+	left = array[start:middle]
+	left_size = len(left)
+	i = 0 # Next item in left
+	j = middle # Next item in the right run
+	k = start # Next place to fill
+	while i < left_size and j < end:
+		left_wins = 0
+		right_wins = 0
+		while i < left_size and j < end:
+			if array[j] < left[i]:
+				array[k] = array[j]
+				j = j + 1
+				right_wins = right_wins + 1
+				left_wins = 0
+			else:
+				array[k] = left[i]
+				i = i + 1
+				left_wins = left_wins + 1
+				right_wins = 0
+			k = k + 1
+			if left_wins >= MIN_GALLOP or right_wins >= MIN_GALLOP:
+				break
+		while i < left_size and j < end:
+			count = _gallop_right(array[j], left, i, left_size) - i
+			array[k:k + count] = left[i:i + count]
+			i = i + count
+			k = k + count
+			if i == left_size:
+				break
+			# left[i] is bigger than array[j] now so this moves at least
+			# one item.
+			right_count = _gallop_left(left[i], array, j, end) - j
+			array[k:k + right_count] = array[j:j + right_count]
+			j = j + right_count
+			k = k + right_count
+			if count < MIN_GALLOP and right_count < MIN_GALLOP:
+				break
+	# Whatever's left of the right run is already where it belongs.
+	array[k:k + left_size - i] = left[i:]
+
+# What a source's head is set to once it has run out.
+_exhausted = object()
+
+def kway_merge(*iterables):
+	'''
+	Merges any number of sorted iterables, yielding their items in
+	sorted order as they're needed. Ties come out in the order of the
+	iterables they came from, so it's stable like _merge().
+
+	_merge() only takes two lists, so merging k of them with it takes
+	log k rounds of copying everything. This uses a tournament tree of
+	losers instead. The leaves are the k sources and each internal node
+	holds the source that lost the match played there, with the overall
+	winner on top. When the winner's item has been yielded the next item
+	from the same source only has to replay the matches on the path from
+	its leaf to the root, about log k comparisons, and nothing is
+	allocated per item.
+
+	>>> list(kway_merge([1, 4, 7], [2, 5, 8], [3, 6, 9]))
+	[1, 2, 3, 4, 5, 6, 7, 8, 9]
+	>>> list(kway_merge([], iter([2, 2]), [1, 3], []))
+	[1, 2, 2, 3]
+	>>> list(kway_merge())
+	[]
+	>>> sources = [sorted(random.randrange(100) for i in range(random.randrange(50))) for j in range(13)]
+	>>> list(kway_merge(*sources)) == sorted(sum(sources, []))
+	True
+	>>> class Keyed(tuple):
+	...     def __lt__(self, other):
+	...         return self[0] < other[0]
+	>>> merged = kway_merge([Keyed((1, 'a')), Keyed((2, 'a'))], [Keyed((1, 'b'))], [Keyed((0, 'c')), Keyed((1, 'c'))])
+	>>> [name for number, name in merged]
+	['c', 'a', 'b', 'c', 'a']
+	'''
+	iterators = list()
+	heads = list()
+	for iterable in iterables:
+		iterator = iter(iterable)
+		head = next(iterator, _exhausted)
+		if head is not _exhausted:
+			iterators.append(iterator)
+			heads.append(head)
+	k = len(iterators)
+	if k == 0:
+		return
+	if k == 1:
+		yield heads[0]
+		for item in iterators[0]:
+			yield item
+		return
+	# Play the first round bottom up. Node n's children are 2n and
+	# 2n + 1 and leaf i is node k + i.
+	tree = [0] * k
+	winners = [0] * k + list(range(k))
+	for node in range(k - 1, 0, -1):
+		first = winners[2 * node]
+		second = winners[2 * node + 1]
+		if first > second:
+			first, second = second, first
+		# The lower numbered source wins ties.
+		if heads[second] < heads[first]:
+			first, second = second, first
+		winners[node] = first
+		tree[node] = second
+	winner = winners[1]
+	remaining = k
+	while True:
+		yield heads[winner]
+		head = heads[winner] = next(iterators[winner], _exhausted)
+		if head is _exhausted:
+			remaining = remaining - 1
+			if not remaining:
+				return
+		node = (winner + k) >> 1
+		while node:
+			challenger = tree[node]
+			challenger_head = heads[challenger]
+			if challenger_head is not _exhausted and (head is _exhausted or
+					(challenger_head < head if challenger > winner else not head < challenger_head)):
+				tree[node] = winner
+				winner = challenger
+				head = challenger_head
+			node = node >> 1
+
+def benchmark_merge(ks=(2, 8, 64, 512), total=10**6):
+	'''
+	Times merging k sorted lists of random floats, total items in all,
+	with kway_merge(), heapq.merge() and rounds of pairwise _merge()
+	calls. Returns a list of (k, kway_merge seconds, heapq.merge
+	seconds, pairwise seconds) tuples.
+
+	>>> [k for k, kway, heap, pairwise in benchmark_merge(ks=(4,), total=1000)]
+	[4]
+	'''
+	results = list()
+	for k in ks:
+		sources = [sorted(random.random() for i in range(total // k)) for j in range(k)]
+		start = time.time()
+		for item in kway_merge(*sources):
+			pass
+		kway = time.time() - start
+		start = time.time()
+		for item in heapq.merge(*sources):
+			pass
+		heap = time.time() - start
+		start = time.time()
+		merging = sources
+		while len(merging) > 1:
+			merging = [_merge(merging[i], merging[i + 1]) if i + 1 < len(merging) else merging[i]
+				for i in range(0, len(merging), 2)]
+		results.append((k, kway, heap, time.time() - start))
+	return results
+
+def benchmark(sizes=(10**3, 10**4, 10**5, 10**6, 10**7)):
+	'''
+	Times mergesort() and bottom_up_mergesort() on random floats. Returns
+	a list of (size, mergesort seconds, bottom_up_mergesort seconds)
+	tuples.
+
+	>>> [size for size, recursive, bottom_up in benchmark(sizes=(1000,))]
+	[1000]
+	'''
+	results = list()
+	for size in sizes:
+		array = [random.random() for i in range(size)]
+		start = time.time()
+		mergesort(array)
+		recursive = time.time() - start
+		start = time.time()
+		bottom_up_mergesort(array)
+		results.append((size, recursive, time.time() - start))
+	return results
+
 if __name__ == "__main__":
 	import doctest
 	doctest.testmod()
@@ -0,0 +1,170 @@
+#!/bin/env python3
+
+'''
+parallel_mergesort
+
+A mergesort of int64s spread over a pool of worker processes. It's
+Python 3 only since it's built on multiprocessing.shared_memory.
+
+The numbers are copied once in to a shared memory buffer and the
+workers work on it in place, so nothing but buffer names and indexes is
+ever pickled. The buffer is cut in to a chunk per worker and each
+worker sorts its chunk with bottom_up_mergesort(). Then the chunks are
+merged in pairs, a round at a time, from the buffer in to a second one
+of the same size and back again. A single pair merge would keep one
+worker busy, so each pair is split in to enough slices to go round the
+pool: _co_rank() finds how much of each chunk comes before the start
+of every slice of the merged output, and then every slice can be
+merged by a different worker without needing anything from the others.
+
+>>> numbers = [random.randrange(-10**15, 10**15) for i in range(10000)]
+>>> parallel_mergesort(numbers, workers=3) == sorted(numbers)
+True
+>>> parallel_mergesort([], workers=2), parallel_mergesort([5, -1], workers=4)
+([], [-1, 5])
+'''
+
+import array
+import concurrent.futures
+import os
+import random
+import time
+from multiprocessing import shared_memory
+
+from mergesort import _merge_into, bottom_up_mergesort
+
+def parallel_mergesort(numbers, workers=None):
+	'''
+	Sorts a sequence of ints that fit in an int64 with workers
+	processes, os.cpu_count() by default, and returns them as a sorted
+	list.
+	'''
+	numbers = array.array('q', numbers)
+	size = len(numbers)
+	workers = workers or os.cpu_count() or 1
+	if size < 2:
+		return numbers.tolist()
+	itemsize = numbers.itemsize
+	buffers = [shared_memory.SharedMemory(create=True, size=size * itemsize) for i in range(2)]
+	views = [memoryview(buffer.buf).cast('q')[:size] for buffer in buffers]
+	try:
+		views[0][:] = numbers
+		del(numbers)
+		with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+			chunks = min(workers, size)
+			runs = [(size * i // chunks, size * (i + 1) // chunks) for i in range(chunks)]
+			_wait([pool.submit(_sort_chunk, buffers[0].name, start, end) for start, end in runs])
+			source = 0
+			while len(runs) > 1:
+				target = 1 - source
+				tasks = list()
+				merged = list()
+				pieces = max(1, workers // (len(runs) // 2))
+				for i in range(0, len(runs) - 1, 2):
+					(left_start, left_end), (right_start, right_end) = runs[i], runs[i + 1]
+					total = right_end - left_start
+					cuts = [total * piece // pieces for piece in range(pieces + 1)]
+					ranks = [_co_rank(cut, views[source], left_start, left_end, right_start, right_end) for cut in cuts]
+					for piece in range(pieces):
+						tasks.append(pool.submit(_merge_slice, buffers[source].name, buffers[target].name,
+							left_start + ranks[piece], left_start + ranks[piece + 1],
+							right_start + cuts[piece] - ranks[piece], right_start + cuts[piece + 1] - ranks[piece + 1],
+							left_start + cuts[piece]))
+					merged.append((left_start, right_end))
+				if len(runs) % 2:
+					start, end = runs[-1]
+					views[target][start:end] = views[source][start:end]
+					merged.append(runs[-1])
+				_wait(tasks)
+				runs = merged
+				source = target
+			return views[source].tolist()
+	finally:
+		for view in views:
+			view.release()
+		for buffer in buffers:
+			buffer.close()
+			buffer.unlink()
+
+def _wait(tasks):
+	for task in tasks:
+		task.result()
+
+def _co_rank(rank, numbers, left_start, left_end, right_start, right_end):
+	'''
+	Returns how many of the first rank items of the stable merge of the
+	sorted runs numbers[left_start:left_end] and
+	numbers[right_start:right_end] come from the left run. It's a binary
+	search, so the split points for a slice of the merge cost O(log N)
+	to find no matter how big the slice is.
+
+	>>> numbers = [1, 3, 5, 7, 2, 3, 4]
+	>>> [_co_rank(rank, numbers, 0, 4, 4, 7) for rank in range(8)]
+	[0, 1, 1, 2, 2, 2, 3, 4]
+	'''
+	left_size = left_end - left_start
+	right_size = right_end - right_start
+	low = max(0, rank - right_size)
+	high = min(rank, left_size)
+	while low < high:
+		i = (low + high) // 2
+		j = rank - i
+		# Too few come from the left if the next left item goes before
+		# the last right one taken. Ties go to the left.
+		if j > 0 and not numbers[right_start + j - 1] < numbers[left_start + i]:
+			low = i + 1
+		else:
+			high = i
+	return low
+
+class _Attached():
+	'''
+	A shared memory buffer opened by name in a worker, as an int64
+	memoryview, for a with statement.
+	'''
+
+	def __init__(self, name):
+		self.buffer = shared_memory.SharedMemory(name=name)
+
+	def __enter__(self):
+		self.view = memoryview(self.buffer.buf).cast('q')
+		return self.view
+
+	def __exit__(self, *exc_info):
+		self.view.release()
+		self.buffer.close()
+
+def _sort_chunk(name, start, end):
+	with _Attached(name) as numbers:
+		numbers[start:end] = array.array('q', bottom_up_mergesort(numbers[start:end].tolist()))
+
+def _merge_slice(source_name, target_name, left_start, left_end, right_start, right_end, out_start):
+	with _Attached(source_name) as source, _Attached(target_name) as target:
+		merging = source[left_start:left_end].tolist() + source[right_start:right_end].tolist()
+		middle = left_end - left_start
+		merged = merging
+		if 0 < middle < len(merging):
+			merged = [None] * len(merging)
+			_merge_into(merging, merged, 0, middle, len(merging))
+		target[out_start:out_start + len(merged)] = array.array('q', merged)
+
+def benchmark(size=50 * 10**6, workers=8):
+	'''
+	Times bottom_up_mergesort() and parallel_mergesort() on size random
+	int64s. Returns a (bottom_up_mergesort seconds, parallel_mergesort
+	seconds) tuple.
+
+	>>> [seconds > 0 for seconds in benchmark(size=1000, workers=2)]
+	[True, True]
+	'''
+	numbers = [random.randrange(-2**63, 2**63) for i in range(size)]
+	start = time.time()
+	bottom_up_mergesort(numbers)
+	single = time.time() - start
+	start = time.time()
+	parallel_mergesort(numbers, workers)
+	return single, time.time() - start
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
@@ -10,10 +10,23 @@ Sorts an array using the quicksort approach to sorting. For example:
 
 '''
 
+import bisect
+import heapq
+import random
+
+from mergesort import _insertion_sort
+
+# Ranges this short or shorter are insertion sorted.
+INSERTION_SORT_SIZE = 16
+
+# Ranges at least this long pick their pivot with a ninther instead of
+# a median of three.
+NINTHER_SIZE = 40
+
 def quicksort(array):
 	'''
 	Sorts an array using the quicksort algorithm. Returns the sorted
-	array.
+	array as a new list and leaves array as it was.
 
 	>>> quicksort([])
 	[]
@@ -27,21 +40,320 @@ def quicksort(array):
 	[1, 2, 3]
 	>>> quicksort([1, 10 , 9, 15, 2, -1, 12, 4, 100, 101])
 	[-1, 1, 2, 4, 9, 10, 12, 15, 100, 101]
+	>>> array = [3, 1, 2]
+	>>> quicksort(array), array
+	([1, 2, 3], [3, 1, 2])
 	'''
-	if len(array) <= 1:
-		# Arrays of length 1 or less are by definition sorted
-		return array
-	else:
-		pivot = array[len(array)/2]
-		del array[len(array)/2]
-		less = list()
-		more = list()
-		for i in array:
-			if i <= pivot:
-				less.append(i)
+	result = list(array)
+	introsort(result)
+	return result
+
+def introsort(array, start=0, end=None):
+	'''
+	Sorts array[start:end] in place with an introsort, a quicksort that
+	can't go quadratic, and returns None like list.sort() does.
+
+	The pivot is the median of three items from the range, or for long
+	ranges Tukey's ninther, the median of three medians of three, so
+	sorted, reversed and organ pipe input still split well. Each
+	partition is three way, less than, equal to and greater than the
+	pivot, so the items equal to the pivot are done with straight away
+	and a range full of duplicates takes one pass instead of going
+	quadratic. Rather than recursing on both sides the smaller side is
+	sorted next and the bigger one goes on a stack for later, which
+	keeps the stack to O(log N). A range that's been partitioned more
+	than 2 log N times without getting short enough is heapsorted
+	instead, which bounds the worst case at O(N log N).
+	Short ranges are insertion sorted.
+
+	>>> array = [5, 3, 8, 1, 9, 2, 7]
+	>>> introsort(array)
+	>>> array
+	[1, 2, 3, 5, 7, 8, 9]
+	>>> array = [9, 8, 7, 6, 5, 4, 3, 2, 1]
+	>>> introsort(array, 2, 7)
+	>>> array
+	[9, 8, 3, 4, 5, 6, 7, 2, 1]
+	>>> for array in ([random.random() for i in range(5000)], [7] * 5000, list(range(5000)),
+	...         list(range(5000, 0, -1)), [random.randrange(3) for i in range(5000)],
+	...         list(range(2500)) + list(range(2500, 0, -1))):
+	...     expected = sorted(array)
+	...     introsort(array)
+	...     assert array == expected
+	'''
+	if end is None:
+		end = len(array)
+	stack = [(start, end, 2 * (end - start).bit_length())]
+	while stack:
+		start, end, depth = stack.pop()
+		while end - start > INSERTION_SORT_SIZE:
+			if not depth:
+				_heapsort(array, start, end)
+				break
+			depth = depth - 1
+			less, more = _partition(array, start, end, _choose_pivot(array, start, end))
+			if less - start < end - more:
+				stack.append((more, end, depth))
+				end = less
 			else:
-				more.append(i)
-		return quicksort(less) + [pivot] + quicksort(more)
+				stack.append((start, less, depth))
+				start = more
+		else:
+			_insertion_sort(array, start, end)
+
+def nth_element(array, k):
+	'''
+	Rearranges array in place so array[k] is the item that would be
+	there if array were sorted, everything before it is no bigger and
+	everything after it is no smaller, and returns array[k]. It's
+	O(N) on average where sorting is O(N log N).
+
+	It's an introselect: introsort() that only carries on in to the
+	side of each partition k is in. If that goes on for more than
+	2 log N partitions the pivots are picked by _median_of_medians()
+	instead, which guarantees O(N) in the worst case too.
+
+	>>> array = [9, 1, 8, 2, 7, 3, 6, 4, 5]
+	>>> nth_element(array, 4)
+	5
+	>>> max(array[:4]) <= array[4] <= min(array[5:])
+	True
+	>>> array = [random.randrange(100) for i in range(1001)]
+	>>> [nth_element(list(array), k) for k in (0, 500, 1000)] == [sorted(array)[k] for k in (0, 500, 1000)]
+	True
+	>>> nth_element([1, 2], 2)
+	Traceback (most recent call last):
+	...
+	IndexError: k is out of range
+	'''
+	if not 0 <= k < len(array):
+		raise IndexError('k is out of range')
+	_multiselect(array, [k])
+	return array[k]
+
+def _multiselect(array, ranks):
+	'''
+	Rearranges array in place so every index in ranks holds the item
+	that would be there if array were sorted, with everything between
+	them in between. Each partition sends the ranks on either side off
+	to that side, so selecting several ranks at once shares all the
+	partitioning the ranks have in common.
+
+	>>> array = [random.random() for i in range(1000)]
+	>>> _multiselect(array, [10, 500, 990])
+	>>> [array[k] for k in (10, 500, 990)] == [sorted(array)[k] for k in (10, 500, 990)]
+	True
+	'''
+	ranks = sorted(set(ranks))
+	if not ranks:
+		return
+	stack = [(0, len(array), ranks, 2 * len(array).bit_length())]
+	while stack:
+		start, end, ranks, depth = stack.pop()
+		if end - start <= INSERTION_SORT_SIZE:
+			_insertion_sort(array, start, end)
+			continue
+		if depth:
+			depth = depth - 1
+			pivot = _choose_pivot(array, start, end)
+		else:
+			pivot = _median_of_medians(array, start, end)
+		less, more = _partition(array, start, end, pivot)
+		low = bisect.bisect_left(ranks, less)
+		high = bisect.bisect_left(ranks, more, low)
+		if low:
+			stack.append((start, less, ranks[:low], depth))
+		if high < len(ranks):
+			stack.append((more, end, ranks[high:], depth))
+
+def _median_of_medians(array, start, end):
+	'''
+	Returns the median of the medians of array[start:end] taken five at
+	a time. At least 30% of the range is no bigger than it and 30% no
+	smaller, so partitioning around it always cuts the range down by a
+	constant fraction.
+
+	>>> _median_of_medians(list(range(25)), 0, 25)
+	12
+	'''
+	medians = list()
+	for first in range(start, end, 5):
+		group = sorted(array[first:min(first + 5, end)])
+		medians.append(group[(len(group) - 1) // 2])
+	return nth_element(medians, (len(medians) - 1) // 2)
+
+def percentiles(array, qs):
+	'''
+	Returns the qs percentiles, each between 0 and 100, of array. A
+	percentile that falls between two items is linearly interpolated
+	between them, the way numpy.percentile() does it by default. All of
+	the ranks needed are selected from one copy of array together, so
+	it's much cheaper than sorting it.
+
+	>>> percentiles([15, 20, 35, 40, 50], [0, 25, 40, 50, 100])
+	[15, 20, 29.0, 35, 50]
+	>>> array = [random.random() for i in range(10001)]
+	>>> percentiles(array, [50, 99]) == [sorted(array)[5000], sorted(array)[9900]]
+	True
+	>>> percentiles([], [50])
+	Traceback (most recent call last):
+	...
+	ValueError: percentiles of an empty array
+	'''
+	if not len(array):
+		raise ValueError('percentiles of an empty array')
+	array = list(array)
+	positions = list()
+	for q in qs:
+		if not 0 <= q <= 100:
+			raise ValueError('percentiles have to be between 0 and 100, not %r' % (q,))
+		positions.append((len(array) - 1) * q / 100.0)
+	ranks = set()
+	for position in positions:
+		ranks.add(int(position))
+		ranks.add(min(int(position) + 1, len(array) - 1))
+	_multiselect(array, ranks)
+	results = list()
+	for position in positions:
+		low = int(position)
+		fraction = position - low
+		if fraction:
+			results.append(array[low] + (array[low + 1] - array[low]) * fraction)
+		else:
+			results.append(array[low])
+	return results
+
+def top_k(array, k, key=None):
+	'''
+	Returns the k biggest items in array, biggest first, like
+	heapq.nlargest() does. Items are compared by key(item) if key is
+	given, and items with the same key come out in the order they were
+	in. The kth biggest is selected with _multiselect() and only the k
+	items from it on are sorted.
+
+	>>> top_k([5, 1, 9, 3, 7, 9], 3)
+	[9, 9, 7]
+	>>> top_k(['bb', 'a', 'ccc', 'dd', 'e'], 2, key=len)
+	['ccc', 'bb']
+	>>> array = [random.randrange(50) for i in range(1000)]
+	>>> top_k(array, 10, key=lambda item: -item) == heapq.nsmallest(10, array)
+	True
+	>>> top_k([1, 2], 0), top_k([1, 2], 5)
+	([], [2, 1])
+	'''
+	if k <= 0:
+		return []
+	if key is None:
+		items = list(array)
+	else:
+		# Negating the index puts earlier items first among equal keys
+		# once the top k are reversed, and stops the items themselves
+		# from ever being compared.
+		items = [(key(item), -index, item) for index, item in enumerate(array)]
+	first = max(len(items) - k, 0)
+	if first:
+		_multiselect(items, [first])
+	top = items[first:]
+	introsort(top)
+	top.reverse()
+	if key is not None:
+		top = [item for item_key, index, item in top]
+	return top
+
+def _choose_pivot(array, start, end):
+	'''
+	Returns the median of three items spread across array[start:end],
+	or for ranges of NINTHER_SIZE or more the median of the medians of
+	three sets of three.
+
+	>>> _choose_pivot([1, 2, 3, 4, 5], 0, 5), _choose_pivot(list(range(100, 0, -1)), 0, 100)
+	(3, 50)
+	'''
+	last = end - 1
+	middle = start + (end - start) // 2
+	if end - start < NINTHER_SIZE:
+		return array[_median_of_three(array, start, middle, last)]
+	step = (end - start) // 8
+	return array[_median_of_three(array,
+		_median_of_three(array, start, start + step, start + 2 * step),
+		_median_of_three(array, middle - step, middle, middle + step),
+		_median_of_three(array, last - 2 * step, last - step, last))]
+
+def _median_of_three(array, a, b, c):
+	'''
+	Returns whichever of the indexes a, b and c holds the middle value.
+	'''
+	x, y, z = array[a], array[b], array[c]
+	if x < y:
+		if y < z:
+			return b
+		return c if x < z else a
+	if x < z:
+		return a
+	return c if y < z else b
+
+def _partition(array, start, end, pivot):
+	'''
+	Dijkstra's Dutch national flag partition of array[start:end] in
+	place around pivot. Returns (less, more) where everything before
+	less is smaller than pivot, everything from more on is bigger and
+	everything in between equals it.
+
+	>>> array = [3, 1, 3, 5, 2, 3, 4]
+	>>> _partition(array, 0, 7, 3), array
+	((2, 5), [1, 2, 3, 3, 3, 4, 5])
+	'''
+	less = start
+	i = start
+	more = end
+	while i < more:
+		item = array[i]
+		if item < pivot:
+			array[i] = array[less]
+			array[less] = item
+			less = less + 1
+			i = i + 1
+		elif pivot < item:
+			more = more - 1
+			array[i] = array[more]
+			array[more] = item
+		else:
+			i = i + 1
+	return less, more
+
+def _heapsort(array, start, end):
+	'''
+	Sorts array[start:end] in place with a heapsort.
+
+	>>> array = [0, 5, 2, 4, 1, 3, 0]
+	>>> _heapsort(array, 1, 6)
+	>>> array
+	[0, 1, 2, 3, 4, 5, 0]
+	'''
+	size = end - start
+	for root in range(size // 2 - 1, -1, -1):
+		_sift_down(array, start, root, size)
+	for last in range(size - 1, 0, -1):
+		array[start], array[start + last] = array[start + last], array[start]
+		_sift_down(array, start, 0, last)
+
+def _sift_down(array, start, root, size):
+	'''
+	Moves the item at root down the max heap in array[start:start + size]
+	until it's no smaller than its children.
+	'''
+	item = array[start + root]
+	while True:
+		child = 2 * root + 1
+		if child >= size:
+			break
+		if child + 1 < size and array[start + child] < array[start + child + 1]:
+			child = child + 1
+		if not item < array[start + child]:
+			break
+		array[start + root] = array[start + child]
+		root = child
+	array[start + root] = item
 
 
 if __name__ == "__main__":
@@ -0,0 +1,229 @@
+#!/bin/env python3
+
+'''
+radixsort
+
+Sorts int64s and byte strings by their digits instead of by comparing
+them, which beats mergesort and quicksort when that's all there is to
+sort. It's Python 3 only since it leans on array's 'q' typecode and on
+bytes indexing to ints.
+
+radixsort() takes the same arguments as mergesort() and quicksort(),
+returns a new sorted list the same way, and picks the variant to use
+from what's in the array:
+
+* Ints are sorted least significant digit first (LSD). Each pass is a
+  stable counting sort on one 8 or 16 bit digit, so after the last
+  pass on the most significant digit everything's in order. The sign
+  bit is flipped first so negative numbers come out before positive
+  ones. With numpy around the passes run over an int64 buffer, where
+  numpy's stable argsort of 8 and 16 bit digits is itself a counting
+  sort. Without it they use lists of buckets.
+* Byte strings are sorted most significant digit first (MSD): they're
+  bucketed on their first byte, each bucket on its second byte and so
+  on, with strings that have run out of bytes going first. Buckets of
+  MSD_CUTOFF strings or fewer are handed to quicksort() instead, since
+  a lot of tiny buckets cost more than they save.
+
+>>> radixsort([5, -3, 2**40, 0, -2**63, 2**63 - 1, 7, -3])
+[-9223372036854775808, -3, -3, 0, 5, 7, 1099511627776, 9223372036854775807]
+>>> radixsort([b'pear', b'apple', b'app', b'', b'fig', b'apple'])
+[b'', b'app', b'apple', b'apple', b'fig', b'pear']
+>>> radixsort([])
+[]
+>>> numbers = [random.randrange(-2**63, 2**63) for i in range(5000)]
+>>> radixsort(numbers) == radixsort(numbers, digit_bits=16) == sorted(numbers)
+True
+>>> strings = [bytes(random.randrange(4) for i in range(random.randrange(6))) for j in range(5000)]
+>>> radixsort(strings) == sorted(strings)
+True
+>>> radixsort([2**63])
+Traceback (most recent call last):
+...
+ValueError: 9223372036854775808 doesn't fit in an int64
+>>> radixsort([1, b'a'])
+Traceback (most recent call last):
+...
+TypeError: radixsort() sorts ints or bytes, not a mix of bytes and int
+'''
+
+import array
+import itertools
+import operator
+import random
+import time
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+from mergesort import mergesort
+from quicksort import quicksort
+
+# MSD buckets this small or smaller are sorted with quicksort().
+MSD_CUTOFF = 32
+
+SIGN_BIT = 1 << 63
+
+# What radixsort() hands straight to lsd_radixsort(). The array argument
+# hides the array module in there.
+array_type = array.array
+BUFFER_TYPES = (array_type,) if numpy is None else (array_type, numpy.ndarray)
+
+def radixsort(array, digit_bits=8):
+	'''
+	Sorts an array of ints that fit in an int64, or of byte strings,
+	and returns it as a new list. digit_bits, 8 or 16, is how wide the
+	digits are for ints: 16 takes half as many passes but each has 256
+	times as many buckets. Integer numpy arrays and array.arrays go
+	straight to lsd_radixsort().
+
+	>>> radixsort(numpy.array([3, 1, 2])), radixsort(array.array('h', [3, -1]))
+	([1, 2, 3], [-1, 3])
+	>>> radixsort([numpy.int32(3), 1])
+	[1, 3]
+	>>> radixsort([True])
+	Traceback (most recent call last):
+	...
+	TypeError: radixsort() sorts ints or bytes, not bool
+	'''
+	if isinstance(array, BUFFER_TYPES):
+		return lsd_radixsort(array, digit_bits).tolist()
+	if not len(array):
+		return []
+	kinds = set(type(item) for item in array)
+	if all(_is_int_type(kind) for kind in kinds):
+		return lsd_radixsort(array, digit_bits).tolist()
+	if kinds == set([bytes]):
+		return _msd_radixsort(list(array), 0)
+	names = sorted(kind.__name__ for kind in kinds)
+	if len(names) > 1:
+		raise TypeError('radixsort() sorts ints or bytes, not a mix of %s' % ' and '.join(names))
+	raise TypeError('radixsort() sorts ints or bytes, not %s' % names[0])
+
+def _is_int_type(kind):
+	if kind is bool:
+		return False
+	return issubclass(kind, int) or numpy is not None and issubclass(kind, numpy.integer)
+
+def lsd_radixsort(values, digit_bits=8):
+	'''
+	Sorts int64s with an LSD radix sort. values can be an integer numpy
+	array, an integer array.array or any sequence of ints. Returns a
+	numpy int64 array if numpy is around or an array.array('q') if it
+	isn't.
+
+	Passes where every item has the same digit are skipped, so small
+	numbers only take as many passes as they have digits.
+
+	>>> lsd_radixsort(array.array('q', [3, -1, 2])).tolist()
+	[-1, 2, 3]
+	>>> lsd_radixsort(array.array('q')).tolist()
+	[]
+	>>> lsd_radixsort(numpy.array([1.7, 0.2, -0.5]))
+	Traceback (most recent call last):
+	...
+	TypeError: lsd_radixsort() sorts ints, not float64
+	>>> lsd_radixsort(numpy.array([2**63], dtype=numpy.uint64))
+	Traceback (most recent call last):
+	...
+	ValueError: 9223372036854775808 doesn't fit in an int64
+	'''
+	if digit_bits not in (8, 16):
+		raise ValueError('digit_bits has to be 8 or 16, not %r' % (digit_bits,))
+	if numpy is None:
+		return _lsd_buckets(values, digit_bits)
+	if isinstance(values, array.array):
+		values = numpy.asarray(values)
+	elif not isinstance(values, numpy.ndarray):
+		values = [operator.index(value) for value in values]
+		try:
+			values = numpy.asarray(values, dtype=numpy.int64)
+		except OverflowError:
+			raise ValueError('%d doesn\'t fit in an int64' % next(value for value in values
+				if not -SIGN_BIT <= value < SIGN_BIT))
+	if values.dtype.kind not in 'iu':
+		raise TypeError('lsd_radixsort() sorts ints, not %s' % values.dtype)
+	if not len(values):
+		return numpy.empty(0, numpy.int64)
+	if values.dtype.kind == 'u' and values.max() >= SIGN_BIT:
+		raise ValueError('%d doesn\'t fit in an int64' % values.max())
+	keys = values.astype(numpy.int64).view(numpy.uint64) ^ numpy.uint64(SIGN_BIT)
+	digit_type = numpy.uint8 if digit_bits == 8 else numpy.uint16
+	mask = numpy.uint64((1 << digit_bits) - 1)
+	for shift in range(0, 64, digit_bits):
+		digits = ((keys >> numpy.uint64(shift)) & mask).astype(digit_type)
+		if (digits == digits[0]).all():
+			continue
+		keys = keys[numpy.argsort(digits, kind='stable')]
+	return (keys ^ numpy.uint64(SIGN_BIT)).view(numpy.int64)
+
+def _lsd_buckets(values, digit_bits):
+	'''
+	lsd_radixsort() for when there's no numpy, with a list per bucket.
+
+	>>> _lsd_buckets([3, -1, 2**40, -2**40], 8).tolist()
+	[-1099511627776, -1, 3, 1099511627776]
+	'''
+	keys = list()
+	for value in values:
+		value = operator.index(value)
+		if not -SIGN_BIT <= value < SIGN_BIT:
+			raise ValueError('%d doesn\'t fit in an int64' % value)
+		keys.append(value + SIGN_BIT) # The same as flipping the sign bit
+	mask = (1 << digit_bits) - 1
+	for shift in range(0, 64, digit_bits):
+		buckets = [[] for i in range(mask + 1)]
+		for key in keys:
+			buckets[(key >> shift) & mask].append(key)
+		if max(len(bucket) for bucket in buckets) < len(keys):
+			keys = list(itertools.chain.from_iterable(buckets))
+	return array.array('q', [key - SIGN_BIT for key in keys])
+
+def _msd_radixsort(strings, depth):
+	'''
+	Sorts byte strings that all have the same first depth bytes.
+	'''
+	if len(strings) <= MSD_CUTOFF:
+		return quicksort(strings)
+	done = list() # Strings with no byte at depth go first
+	buckets = [None] * 256
+	for string in strings:
+		if len(string) > depth:
+			byte = string[depth]
+			if buckets[byte] is None:
+				buckets[byte] = [string]
+			else:
+				buckets[byte].append(string)
+		else:
+			done.append(string)
+	for bucket in buckets:
+		if bucket is not None:
+			done.extend(_msd_radixsort(bucket, depth + 1))
+	return done
+
+def benchmark(size=10**6):
+	'''
+	Times radixsort(), mergesort(), quicksort() and sorted() on size
+	random int64s and on size random 8 byte strings. Returns a dict of
+	(kind, sort name) to seconds.
+
+	>>> sorted(benchmark(size=1000).keys())[:2]
+	[('bytes', 'mergesort'), ('bytes', 'quicksort')]
+	'''
+	inputs = {
+		'int64': [random.randrange(-SIGN_BIT, SIGN_BIT) for i in range(size)],
+		'bytes': [bytes(random.randrange(256) for i in range(8)) for j in range(size)],
+	}
+	results = dict()
+	for kind, values in inputs.items():
+		for sort in (radixsort, mergesort, quicksort, sorted):
+			start = time.time()
+			sort(values)
+			results[(kind, sort.__name__)] = time.time() - start
+	return results
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()
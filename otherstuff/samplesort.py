@@ -0,0 +1,159 @@
+#!/bin/env python3
+
+'''
+samplesort
+
+A parallel sample sort for big numeric arrays, to go with quicksort for
+when one core isn't enough. It's Python 3 only since it's built on
+multiprocessing.shared_memory, and it needs numpy.
+
+quicksort() partitions around one pivot at a time, so there's only
+ever one partition in flight. A sample sort picks workers - 1 splitters
+up front from a sorted random sample of oversampling items per worker,
+which cuts the input in to workers buckets of about the same size in
+one go. Then:
+
+1. Each worker takes a chunk of the input and counts how many of its
+   items fall in each bucket, with numpy.searchsorted() against the
+   splitters.
+2. Adding up the counts gives every chunk the place in the output
+   where its share of each bucket starts, and each worker scatters its
+   chunk's items there.
+3. Each worker sorts one bucket of the output in place. The buckets
+   are already in order so once they're sorted so is the output.
+
+The input and output live in shared memory, so workers only ever get
+sent buffer names and offsets.
+
+How well the buckets come out balanced depends on the sample. The
+imbalance is the biggest bucket over the mean bucket size, so 1.0 is
+perfect and the sort takes about that many times longer than it would
+with perfect buckets. Lots of copies of one value all land in the one
+bucket, so heavily duplicated input can balance badly.
+
+>>> numbers = numpy.random.randint(-10**9, 10**9, size=100000)
+>>> stats = dict()
+>>> result = sample_sort(numbers, workers=4, stats=stats)
+>>> bool((result == numpy.sort(numbers)).all())
+True
+>>> len(stats['buckets']), sum(stats['buckets']), stats['imbalance'] < 1.5
+(4, 100000, True)
+>>> sample_sort([3.5, -1.0, 2.0], workers=2).tolist()
+[-1.0, 2.0, 3.5]
+'''
+
+import concurrent.futures
+import os
+import time
+from multiprocessing import shared_memory
+
+import numpy
+
+def sample_sort(array, workers=None, oversampling=32, stats=None):
+	'''
+	Sorts a one dimensional numeric array, or anything numpy.asarray()
+	makes one of, with workers processes, os.cpu_count() by default.
+	Returns the sorted numpy array. If stats is a dict the bucket sizes
+	and the imbalance are put in it.
+	'''
+	values = numpy.asarray(array)
+	size = len(values)
+	if size < 2:
+		if stats is not None:
+			stats['buckets'] = [size]
+			stats['imbalance'] = 1.0
+		return numpy.array(values)
+	workers = max(1, min(workers or os.cpu_count() or 1, size))
+	sample = numpy.sort(values[numpy.random.randint(0, size, size=workers * oversampling)])
+	splitters = sample[oversampling::oversampling][:workers - 1]
+	buffers = [shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1)) for i in range(2)]
+	try:
+		numpy.ndarray(values.shape, values.dtype, buffers[0].buf)[:] = values
+		chunks = [(size * i // workers, size * (i + 1) // workers) for i in range(workers)]
+		with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+			counts = numpy.array(list(pool.map(_count, [(buffers[0].name, values.dtype.str, size, splitters, start, end)
+				for start, end in chunks])), dtype=numpy.int64).reshape(workers, workers)
+			# Bucket b starts after all the smaller buckets, and chunk c's
+			# share of it after the earlier chunks' shares.
+			buckets = counts.sum(axis=0)
+			bucket_starts = numpy.concatenate(([0], numpy.cumsum(buckets)[:-1]))
+			offsets = bucket_starts + numpy.cumsum(counts, axis=0) - counts
+			list(pool.map(_scatter, [(buffers[0].name, buffers[1].name, values.dtype.str, size, splitters, start, end, offsets[chunk])
+				for chunk, (start, end) in enumerate(chunks)]))
+			list(pool.map(_sort_bucket, [(buffers[1].name, values.dtype.str, size, start, start + count)
+				for start, count in zip(bucket_starts, buckets)]))
+		result = numpy.array(numpy.ndarray(values.shape, values.dtype, buffers[1].buf))
+	finally:
+		for buffer in buffers:
+			buffer.close()
+			buffer.unlink()
+	if stats is not None:
+		stats['buckets'] = buckets.tolist()
+		stats['imbalance'] = float(buckets.max()) * workers / size
+	return result
+
+def _count(job):
+	name, dtype, size, splitters, start, end = job
+	buffer = shared_memory.SharedMemory(name=name)
+	try:
+		values = numpy.ndarray((size,), dtype, buffer.buf)[start:end]
+		buckets = numpy.searchsorted(splitters, values, side='right')
+		counts = numpy.bincount(buckets, minlength=len(splitters) + 1)
+		del(values)
+		return counts
+	finally:
+		buffer.close()
+
+def _scatter(job):
+	source_name, target_name, dtype, size, splitters, start, end, offsets = job
+	source_buffer = shared_memory.SharedMemory(name=source_name)
+	target_buffer = shared_memory.SharedMemory(name=target_name)
+	try:
+		values = numpy.ndarray((size,), dtype, source_buffer.buf)[start:end]
+		target = numpy.ndarray((size,), dtype, target_buffer.buf)
+		buckets = numpy.searchsorted(splitters, values, side='right')
+		order = numpy.argsort(buckets, kind='stable')
+		grouped = values[order]
+		bounds = numpy.searchsorted(buckets[order], numpy.arange(len(splitters) + 2))
+		for bucket in range(len(splitters) + 1):
+			first, last = bounds[bucket], bounds[bucket + 1]
+			target[offsets[bucket]:offsets[bucket] + last - first] = grouped[first:last]
+		del(values, target)
+	finally:
+		source_buffer.close()
+		target_buffer.close()
+
+def _sort_bucket(job):
+	name, dtype, size, start, end = job
+	buffer = shared_memory.SharedMemory(name=name)
+	try:
+		bucket = numpy.ndarray((size,), dtype, buffer.buf)[start:end]
+		bucket.sort()
+		del(bucket)
+	finally:
+		buffer.close()
+
+def benchmark(size=10**7, workers=8):
+	'''
+	Times numpy.sort() and sample_sort() on size random int64s. Returns
+	a dict of the two times and the bucket imbalance.
+
+	>>> sorted(benchmark(size=10000, workers=2).keys())
+	['imbalance', 'numpy_seconds', 'sample_sort_seconds']
+	'''
+	numbers = numpy.random.randint(-2**63, 2**63 - 1, size=size, dtype=numpy.int64)
+	start = time.time()
+	numpy.sort(numbers)
+	single = time.time() - start
+	stats = dict()
+	start = time.time()
+	sample_sort(numbers, workers, stats=stats)
+	return {
+		'numpy_seconds': single,
+		'sample_sort_seconds': time.time() - start,
+		'imbalance': stats['imbalance'],
+	}
+
+if __name__ == '__main__':
+	import doctest
+	doctest.testmod()